@@ -4,20 +4,38 @@ Simple binary environments for experimenting with teacher-student interactions
 author: William Tong (wtong@g.harvard.edu)
 """
 # <codecell>
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import asdict, dataclass, field
+import copy
+from functools import lru_cache
+import hashlib
 import itertools
-from multiprocessing import Pool
+import json
+import math
+from multiprocessing import Pipe, Process, shared_memory
 
 import numbers
+import os
+import pickle
+import shutil
+import sys
+import time
 import warnings
 import gym
 import numpy as np
 import matplotlib.pyplot as plt
 
+from scipy import sparse
 from scipy.stats import beta
 from sklearn.metrics.pairwise import rbf_kernel
 from tqdm import tqdm
 
+try:
+    import resource
+except ImportError:   # Unix only
+    resource = None
+
 def sig(x):
     return 1 / (1 + np.exp(-x))
 
@@ -390,6 +408,111 @@ class TeacherUncertainOsc(Agent):
         return 1 - prob_bad
 
 
+class TeacherUncertainHasty(Agent):
+    def __init__(self, target_threshold=0.5, confidence=0.95, max_k=10, max_m=150, n_particles=1000, eps_prior=None, fixed_prior=True) -> None:
+        super().__init__()
+        self.target_threshold = target_threshold
+        self.confidence = confidence
+        self.max_k = max_k
+        self.max_m = max_m
+        self.n_particles = n_particles
+        self.eps_prior = eps_prior or np.random.randn
+        self.fixed_prior = fixed_prior
+        self.student_traj = []
+
+        self.cum_probs = None
+
+    def next_action(self, state):
+        _, history = state
+        self.student_traj.extend(history)
+
+        max_thresh = self._get_max_thresh()
+        return self._get_jump(max_thresh)
+
+    def _get_jump(self, s_n):
+        confs = self._sim_probs(s_n)
+        below = np.flatnonzero(confs < self.confidence)
+        k = below[0] + 1 if len(below) > 0 else self.max_k - 1
+        return k - 1
+
+    def _get_max_thresh(self):
+        trans = np.array(self.student_traj[-self.max_m:][::-1], dtype=int)
+        if len(trans) == 0:
+            return 1e-8
+
+        n_success = np.cumsum(trans)
+        n_fail = np.arange(1, len(trans) + 1) - n_success
+        threshs = beta.ppf(1 - self.confidence, n_success + 1, n_fail + 1)
+        return max(np.max(threshs), 1e-8)
+
+    def _get_cum_probs(self):
+        if self.cum_probs is None or not self.fixed_prior:
+            samp_eps = self.eps_prior(size=(self.n_particles, self.max_k - 1))
+            self.cum_probs = np.cumprod(1 / (1 + np.exp(-samp_eps)), axis=1)
+
+        return self.cum_probs
+
+    def _sim_probs(self, s_n):
+        '''
+        success fraction for every k in [1, max_k), where the k-th column
+        is the probability of clearing k consecutive fresh states
+        '''
+        cum_probs = self._get_cum_probs()
+        return np.mean(cum_probs > self.target_threshold / s_n, axis=0)
+
+    def _sim_prob(self, k, s_n):
+        return self._sim_probs(s_n)[k - 1]
+
+    def reset(self):
+        self.student_traj = []
+        if not self.fixed_prior:
+            self.cum_probs = None
+
+
+class TeacherUncertainAdaptive(TeacherUncertainHasty):
+    def __init__(self, p_eps=0.05, max_m_factor=3, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.p_eps = p_eps
+        self.success_prob = np.exp(-p_eps)
+
+        raw_min_m = np.log(1 - self.confidence) / (-p_eps) - 1
+        self.min_m = int(np.floor(raw_min_m))
+        self.max_m = int(self.min_m * max_m_factor)
+
+    def next_action(self, state):
+        _, trans = state
+        self.student_traj.extend(trans)
+
+        if self._is_confident():
+            jump = self.compute_jump()
+            if jump == 0:
+                print('warn: jump=0, clipping to 1')
+                jump = 1
+            return jump
+
+        return 0
+
+    def _is_confident(self):
+        max_m = min(self.max_m, len(self.student_traj))
+        if max_m < self.min_m:
+            return False
+
+        trans = np.array(self.student_traj[-max_m:][::-1], dtype=int)
+        success = np.cumsum(trans)[self.min_m - 1:]
+        total = np.arange(self.min_m, max_m + 1)
+        prob_bad = beta.cdf(self.success_prob, a=success+1, b=total-success+1)
+        return np.any(1 - prob_bad >= self.confidence)
+
+    def _get_prob_good(self, transcript):
+        success = np.sum(transcript)
+        total = len(transcript)
+        prob_bad = beta.cdf(self.success_prob, a=success+1, b=total-success+1)
+        return 1 - prob_bad
+
+    def compute_jump(self):
+        return self._get_jump(self.success_prob)
+
+
 # TODO: clean up and work out rigorous tuning
 class TeacherAdaptive(Agent):
     def __init__(self, goal_length, threshold=0.95, threshold_low=0.05, tau=0.5, conf=0.95, max_m_factor=3, abs_min_m=5, cut_factor=2, student=None, with_osc=False) -> None:
@@ -558,11 +681,657 @@ class TeacherTree:
         return result
 
 
+def _peak_mem_mb():
+    '''
+    peak resident memory of this process in MB, or None where the resource
+    module is unavailable. ru_maxrss is in bytes on macOS and KB elsewhere
+    '''
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss / 1024 ** 2
+    return max_rss / 1024
+
+
+@dataclass
+class SearchStats:
+    '''
+    Per-decision statistics from a tree-search teacher. Times are in seconds;
+    under root-parallel search, rollout_time is summed across workers
+    '''
+    n_sims: int = 0
+    elapsed: float = 0
+    rollout_time: float = 0
+    n_nodes: int = 0
+    n_particles: int = 0
+    peak_mem_mb: float = None
+    depth_hist: dict = field(default_factory=dict)
+
+    @property
+    def sims_per_sec(self):
+        return self.n_sims / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def tree_time(self):
+        return max(self.elapsed - self.rollout_time, 0)
+    
+    def record_depth(self, depth):
+        self.n_sims += 1
+        self.depth_hist[depth] = self.depth_hist.get(depth, 0) + 1
+    
+    def absorb(self, other):
+        self.n_sims += other.n_sims
+        self.rollout_time += other.rollout_time
+        for depth, count in other.depth_hist.items():
+            self.depth_hist[depth] = self.depth_hist.get(depth, 0) + count
+    
+    def finish(self, start_time, n_nodes=0, n_particles=0):
+        self.elapsed = time.perf_counter() - start_time
+        self.n_nodes = n_nodes
+        self.n_particles = n_particles
+        self.peak_mem_mb = _peak_mem_mb()
+        return self
+    
+    def to_dict(self):
+        summary = asdict(self)
+        summary['sims_per_sec'] = self.sims_per_sec
+        summary['tree_time'] = self.tree_time
+        summary['depth_hist'] = {int(k): v for k, v in sorted(self.depth_hist.items())}
+        return summary
+    
+    @staticmethod
+    def aggregate(all_stats):
+        total = SearchStats()
+        for stats in all_stats:
+            total.absorb(stats)
+            total.elapsed += stats.elapsed
+            total.n_nodes = max(total.n_nodes, stats.n_nodes)
+            total.n_particles = max(total.n_particles, stats.n_particles)
+            if stats.peak_mem_mb is not None:
+                total.peak_mem_mb = max(total.peak_mem_mb or 0, stats.peak_mem_mb)
+        return total
+
+
+class SearchLog:
+    '''
+    Level-gated output for tree-search teachers. Level 1 covers warnings and
+    info, level 2 the per-decision diagnostics. Stats are kept in memory and,
+    if path is set, appended to it as JSON lines
+    '''
+    def __init__(self, verbose=1, path=None, keep_stats=True) -> None:
+        self.verbose = verbose
+        self.path = path
+        self.keep_stats = keep_stats
+        self.all_stats = []
+    
+    def __call__(self, level, *args):
+        if level <= self.verbose:
+            print(*args)
+    
+    def record(self, stats):
+        if self.keep_stats:
+            self.all_stats.append(stats)
+
+        if self.path != None:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(stats.to_dict()) + '\n')
+    
+    def summary(self):
+        return SearchStats.aggregate(self.all_stats)
+
+
+def _config_hash(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class OpeningBook:
+    '''
+    Search statistics from the first few decisions of a run, pickled to path
+    suffixed with a hash of the teacher configuration, so later runs with the
+    same configuration can warm-start their search. Each configuration gets
+    its own file, so runs with different configurations never overwrite each
+    other's books
+    '''
+    def __init__(self, path, config) -> None:
+        self.config = config
+        self.key = _config_hash(config)
+        self.path = f'{path}.{self.key}'
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path, 'rb') as fp:
+            return pickle.load(fp)
+    
+    def save(self, entries):
+        # write then rename, so concurrent runs never read a partial file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            pickle.dump(entries, fp)
+        os.replace(tmp_path, self.path)
+
+
+class SearchBudget:
+    '''
+    Stopping rule for anytime search. With time_budget_ms set, search runs
+    until the wall-clock deadline rather than for a fixed number of
+    simulations. With early_stop_delta set, search also stops once the lead
+    of the best root action over the runner-up exceeds the sum of their
+    Hoeffding confidence radii at level delta, for returns in [0, value_range]
+    '''
+    def __init__(self, time_budget_ms=None, early_stop_delta=None, value_range=10) -> None:
+        self.time_budget_ms = time_budget_ms
+        self.early_stop_delta = early_stop_delta
+        self.value_range = value_range
+        self.deadline = None
+    
+    def start(self):
+        self.deadline = None
+        if self.time_budget_ms != None:
+            # NOTE: wall-clock time, so the deadline holds in worker processes
+            self.deadline = time.time() + self.time_budget_ms / 1000
+        return self
+    
+    def sim_range(self, n_sims):
+        if self.time_budget_ms != None:
+            return itertools.count()
+        return range(n_sims)
+    
+    def is_settled(self, n_a, v_a):
+        if self.early_stop_delta == None or len(v_a) < 2:
+            return False
+
+        second, best = np.argsort(v_a)[-2:]
+        if n_a[best] == 0 or n_a[second] == 0:
+            return False
+        
+        scale = self.value_range * np.sqrt(np.log(2 / self.early_stop_delta) / 2)
+        radius = scale * (1 / np.sqrt(n_a[best]) + 1 / np.sqrt(n_a[second]))
+        return v_a[best] - v_a[second] > radius
+    
+    def should_stop(self, n_a=None, v_a=None):
+        if self.deadline != None and time.time() >= self.deadline:
+            return True
+        return n_a is not None and self.is_settled(np.asarray(n_a), np.asarray(v_a))
+
+
+class RolloutValueCache:
+    '''
+    Online table of rollout returns, keyed by a coarse summary of the student
+    state: the task length n, the frontier (first item at which the cumulative
+    success log-probability drops below -p_eps) and a bin of the probability
+    of passing the whole task, along with the steps left before the rollout
+    is cut off at horizon, since a truncated return is smaller than a full
+    one. Once a cell has min_count samples and a standard error below tol,
+    its mean stands in for the rest of a rollout with the same steps left.
+    With track_n=False, n is ignored and the probability covers all items
+    '''
+    def __init__(self, goal_length, horizon, p_eps=0.05, n_bins=10, min_count=30, tol=0.25, track_n=True) -> None:
+        self.goal_length = goal_length
+        self.horizon = horizon
+        self.p_eps = p_eps
+        self.n_bins = n_bins
+        self.min_count = min_count
+        self.tol = tol
+        self.track_n = track_n
+
+        shape = (goal_length + 1 if track_n else 1, goal_length + 1, n_bins, horizon + 1)
+        self.count = np.zeros(shape, dtype=int)
+        self.total = np.zeros(shape)
+        self.total_sq = np.zeros(shape)
+    
+    @staticmethod
+    def horizon_for(gamma, eps):
+        '''
+        rollouts run while gamma ** depth > eps, so at most this many steps
+        '''
+        return max(int(np.ceil(np.log(eps) / np.log(gamma))), 0)
+    
+    def _index(self, n, log_probs, depth):
+        log_probs = np.atleast_2d(log_probs)
+        cum_log_probs = np.cumsum(log_probs, axis=1)
+
+        below = cum_log_probs < -self.p_eps
+        frontier = np.where(np.any(below, axis=1), np.argmax(below, axis=1), log_probs.shape[1])
+
+        if self.track_n:
+            n = np.atleast_1d(n).astype(int)
+            log_prob = cum_log_probs[np.arange(len(n)), n - 1]
+        else:
+            n = np.zeros(len(log_probs), dtype=int)
+            log_prob = cum_log_probs[:,-1]
+        
+        prob_bin = np.minimum((np.exp(log_prob) * self.n_bins).astype(int), self.n_bins - 1)
+        steps_left = np.clip(self.horizon - np.broadcast_to(depth, len(log_probs)), 0, self.horizon)
+        return n, frontier, prob_bin, steps_left
+    
+    def lookup(self, n, log_probs, depth):
+        idx = self._index(n, log_probs, depth)
+        count = self.count[idx]
+        mean = self.total[idx] / np.maximum(count, 1)
+        var = self.total_sq[idx] / np.maximum(count, 1) - mean ** 2
+        std_err = np.sqrt(np.maximum(var, 0) / np.maximum(count, 1))
+
+        is_confident = (count >= self.min_count) & (std_err < self.tol)
+        return is_confident, mean
+    
+    def update(self, n, log_probs, depth, values):
+        idx = self._index(n, log_probs, depth)
+        values = np.atleast_1d(values)
+        np.add.at(self.count, idx, 1)
+        np.add.at(self.total, idx, values)
+        np.add.at(self.total_sq, idx, values ** 2)
+    
+    def merge(self, caches):
+        '''
+        Fold in copies of this cache that were updated elsewhere (e.g. in
+        worker processes), counting only what they added since the copy
+        '''
+        base = (self.count.copy(), self.total.copy(), self.total_sq.copy())
+        for cache in caches:
+            self.count += cache.count - base[0]
+            self.total += cache.total - base[1]
+            self.total_sq += cache.total_sq - base[2]
+
+
+def _belief_stats(qr, qe, lr, weights):
+    '''
+    weighted mean and std of each of qr, qe and lr over a belief's members
+    '''
+    w = weights / np.sum(weights)
+
+    def _moments(vals):
+        mean = np.tensordot(w, vals, axes=1)
+        std = np.sqrt(np.tensordot(w, (vals - mean) ** 2, axes=1))
+        return mean, std
+
+    qr_mean, qr_std = _moments(qr)
+    qe_mean, qe_std = _moments(qe)
+    lr_mean, lr_std = _moments(lr)
+    return qr_mean, qr_std, qe_mean, qe_std, lr_mean, lr_std
+
+
+class ParticleBelief:
+    '''
+    Contiguous, weighted particle store for a single POMCP belief node. Once
+    max_particles is reached, new particles replace old ones by reservoir
+    sampling, so the store stays a uniform sample of everything it has seen.
+
+    Search only adds a particle to a node when its simulated observation
+    lands in that node's bin, so each particle is already a draw from the
+    posterior and enters with weight 1. With equal weights, the reservoir is
+    the resampled belief, and the belief update needs no reweighting step.
+    Weights only matter for particles added with an explicit weight, and
+    resample() turns such a store back into an equally weighted one
+    '''
+    def __init__(self, goal_length, max_particles=None, capacity=16) -> None:
+        self.goal_length = goal_length
+        self.max_particles = max_particles
+        self.size = 0
+        self.n_seen = 0
+
+        if max_particles != None:
+            capacity = min(capacity, max_particles)
+
+        self.n = np.zeros(capacity, dtype=np.int64)
+        self.qr = np.zeros((capacity, goal_length))
+        self.qe = np.zeros(capacity)
+        self.lr = np.zeros(capacity)
+        self.weights = np.zeros(capacity)
+    
+    def __len__(self):
+        return self.size
+    
+    def _grow(self):
+        capacity = 2 * len(self.n)
+        if self.max_particles != None:
+            capacity = min(capacity, self.max_particles)
+
+        self.n = np.resize(self.n, capacity)
+        self.qr = np.resize(self.qr, (capacity, self.goal_length))
+        self.qe = np.resize(self.qe, capacity)
+        self.lr = np.resize(self.lr, capacity)
+        self.weights = np.resize(self.weights, capacity)
+    
+    def _next_slot(self):
+        self.n_seen += 1
+        if self.max_particles == None or self.size < self.max_particles:
+            if self.size == len(self.n):
+                self._grow()
+            self.size += 1
+            return self.size - 1
+
+        idx = np.random.randint(self.n_seen)
+        return idx if idx < self.max_particles else -1
+
+    def add(self, state, weight=1):
+        idx = self._next_slot()
+        if idx >= 0:
+            self.n[idx], self.qr[idx], self.qe[idx], self.lr[idx] = state
+            self.weights[idx] = weight
+    
+    def add_batch(self, n, qr, qe, lr, weights=None):
+        if weights is None:
+            weights = np.ones(len(n))
+
+        n_direct = len(n)
+        if self.max_particles != None:
+            n_direct = min(n_direct, max(self.max_particles - self.size, 0))
+        
+        if n_direct > 0:
+            while self.size + n_direct > len(self.n):
+                self._grow()
+
+            sl = slice(self.size, self.size + n_direct)
+            self.n[sl], self.qr[sl], self.qe[sl], self.lr[sl] = n[:n_direct], qr[:n_direct], qe[:n_direct], lr[:n_direct]
+            self.weights[sl] = weights[:n_direct]
+            self.size += n_direct
+            self.n_seen += n_direct
+
+        for i in range(n_direct, len(n)):
+            self.add((n[i], qr[i], qe[i], lr[i]), weights[i])
+    
+    def arrays(self):
+        return (self.n[:self.size], self.qr[:self.size], self.qe[:self.size],
+                self.lr[:self.size], self.weights[:self.size])
+    
+    def get(self, idx):
+        return (self.n[idx], self.qr[idx], self.qe[idx], self.lr[idx])
+    
+    def sample_idxs(self, size):
+        weights = self.weights[:self.size]
+        return np.random.choice(self.size, size=size, p=weights / np.sum(weights))
+    
+    def resample(self, size=None):
+        '''
+        draw size particles by weight into a new, equally weighted store
+        '''
+        size = size or self.size
+        idxs = self.sample_idxs(size)
+
+        resampled = ParticleBelief(self.goal_length, self.max_particles, capacity=size)
+        resampled.add_batch(self.n[idxs], self.qr[idxs], self.qe[idxs], self.lr[idxs])
+        return resampled
+    
+    def stats(self):
+        return _belief_stats(self.qr[:self.size], self.qe[:self.size], self.lr[:self.size],
+                             self.weights[:self.size])
+
+
+class GridBelief:
+    '''
+    Discretized posterior over the student's (qe, lr), with n_qr_samples
+    draws of qr carried per grid cell. Exposes the same read interface as
+    ParticleBelief, so search samples root states from it directly
+    '''
+    def __init__(self, goal_length, qe_axis, lr_axis, n_qr_samples=8, mix=1e-3) -> None:
+        self.goal_length = goal_length
+        self.n_cells = len(qe_axis) * len(lr_axis)
+        self.n_qr_samples = n_qr_samples
+        self.mix = mix
+
+        qe, lr = np.meshgrid(qe_axis, lr_axis, indexing='ij')
+        self.size = self.n_cells * n_qr_samples
+        self.qe = np.repeat(qe.flatten(), n_qr_samples)
+        self.lr = np.repeat(lr.flatten(), n_qr_samples)
+        self.n = np.ones(self.size, dtype=np.int64)
+        self.qr = np.zeros((self.size, goal_length))
+        self.weights = np.full(self.size, 1 / self.size)
+    
+    def __len__(self):
+        return self.size
+    
+    def update(self, action, obs, transition, obs_std=1):
+        '''
+        propagate every member through transition (a batched student kernel
+        returning (n, qr, obs, reward, is_done)) and reweight by a Gaussian
+        likelihood over the distance between predicted and observed bins
+        '''
+        actions = np.full(self.size, action)
+        self.n, self.qr, pred_obs, _, _ = transition(self.n, self.qr, self.qe, self.lr, actions)
+
+        log_w = np.log(self.weights) - 0.5 * ((pred_obs - obs) / obs_std) ** 2
+        weights = np.exp(log_w - np.max(log_w))
+        weights /= np.sum(weights)
+        self.weights = (1 - self.mix) * weights + self.mix / self.size
+        self._resample_cells()
+    
+    def _resample_cells(self):
+        '''
+        systematic resampling of qr within each cell, keeping the cell's
+        total weight, so qr samples follow the posterior without moving mass
+        between (qe, lr) cells
+        '''
+        K = self.n_qr_samples
+        weights = self.weights.reshape(self.n_cells, K)
+        cell_weights = np.sum(weights, axis=1)
+        cum_probs = np.cumsum(weights / cell_weights.reshape(-1, 1), axis=1)
+
+        u = (np.arange(K) + np.random.random((self.n_cells, 1))) / K
+        idxs = np.sum(cum_probs[:,np.newaxis,:] < u[:,:,np.newaxis], axis=2)
+        idxs = np.minimum(idxs, K - 1) + K * np.arange(self.n_cells).reshape(-1, 1)
+        idxs = idxs.flatten()
+
+        self.n = self.n[idxs]
+        self.qr = self.qr[idxs]
+        self.weights = np.repeat(cell_weights / K, K)
+    
+    def get(self, idx):
+        return (self.n[idx], self.qr[idx], self.qe[idx], self.lr[idx])
+    
+    def sample_idxs(self, size):
+        return np.random.choice(self.size, size=size, p=self.weights / np.sum(self.weights))
+    
+    def stats(self):
+        return _belief_stats(self.qr, self.qe, self.lr, self.weights)
+
+
+class PomcpTree:
+    '''
+    Array-backed POMCP search tree. Belief nodes are integer ids into
+    parallel arrays, with per-action statistics stored on the parent
+    belief node and a (action, observation bin) -> child id table
+    '''
+    def __init__(self, n_actions, n_obs, goal_length, max_particles=None, capacity=1024) -> None:
+        self.n_actions = n_actions
+        self.n_obs = n_obs
+        self.goal_length = goal_length
+        self.max_particles = max_particles
+        self.size = 0
+
+        self.n = np.zeros(capacity, dtype=np.int64)
+        self.n_a = np.zeros((capacity, n_actions), dtype=np.int64)
+        self.v_a = np.zeros((capacity, n_actions))
+        self.child = np.full((capacity, n_actions, n_obs), -1, dtype=np.int32)
+        self.last_visit = np.zeros(capacity, dtype=np.int64)
+        self.beliefs = []
+        self.tick = 0
+
+        self.root = self.add_node()
+    
+    def __len__(self):
+        return self.size
+    
+    def _grow(self):
+        capacity = 2 * len(self.n)
+        self.last_visit = np.resize(self.last_visit, capacity)
+        self.n = np.resize(self.n, capacity)
+        self.n_a = np.resize(self.n_a, (capacity, self.n_actions))
+        self.v_a = np.resize(self.v_a, (capacity, self.n_actions))
+        self.child = np.resize(self.child, (capacity, self.n_actions, self.n_obs))
+    
+    def add_node(self, parent=-1, action=None, obs=None):
+        if self.size == len(self.n):
+            self._grow()
+
+        idx = self.size
+        self.n[idx] = 0
+        self.n_a[idx] = 0
+        self.v_a[idx] = 0
+        self.child[idx] = -1
+        self.last_visit[idx] = self.tick
+        self.beliefs.append(None)
+        self.size += 1
+
+        if parent >= 0:
+            self.child[parent, action, obs] = idx
+        return idx
+    
+    def get_child(self, node, action, obs):
+        return self.child[node, action, obs]
+    
+    def touch(self, node):
+        self.last_visit[node] = self.tick
+    
+    def reroot(self, node):
+        '''
+        make node the new root, dropping every branch that is no longer reachable
+        '''
+        self._compact(node, np.ones(self.size, dtype=bool))
+    
+    def prune(self, max_nodes, policy='lru'):
+        '''
+        evict nodes until at most max_nodes remain. Under 'lru' the least
+        recently visited nodes go first, under 'visits' the least visited.
+        Either score never exceeds the parent's, so evicting by threshold
+        removes whole subtrees
+        '''
+        max_nodes = max(max_nodes, 1)
+        if self.size <= max_nodes:
+            return
+
+        if policy == 'lru':
+            score = self.last_visit[:self.size]
+        elif policy == 'visits':
+            score = self.n[:self.size]
+        else:
+            raise ValueError(f'unrecognized prune policy: {policy}')
+
+        cutoff = np.sort(score)[::-1][max_nodes - 1]
+        keep = score > cutoff
+        if np.sum(score >= cutoff) <= max_nodes:
+            keep = score >= cutoff
+
+        self._compact(self.root, keep)
+    
+    def _compact(self, root, keep):
+        keep[root] = True
+        ids = [np.array([root])]
+        frontier = ids[0]
+        while len(frontier) > 0:
+            kids = self.child[frontier].ravel()
+            kids = kids[kids >= 0]
+            frontier = kids[keep[kids]]
+            ids.append(frontier)
+        ids = np.concatenate(ids)
+
+        remap = np.full(self.size, -1, dtype=np.int32)
+        remap[ids] = np.arange(len(ids))
+        child = self.child[ids]
+        child[child >= 0] = remap[child[child >= 0]]
+
+        capacity = max(len(ids), 1024)
+        self.n = np.resize(self.n[ids], capacity)
+        self.n_a = np.resize(self.n_a[ids], (capacity, self.n_actions))
+        self.v_a = np.resize(self.v_a[ids], (capacity, self.n_actions))
+        self.child = np.resize(child, (capacity, self.n_actions, self.n_obs))
+        self.last_visit = np.resize(self.last_visit[ids], capacity)
+        self.beliefs = [self.beliefs[i] for i in ids]
+
+        self.size = len(ids)
+        self.root = 0
+    
+    def add_particle(self, node, state):
+        if self.beliefs[node] is None:
+            self.beliefs[node] = ParticleBelief(self.goal_length, self.max_particles)
+        self.beliefs[node].add(state)
+    
+    def n_particles(self, node):
+        belief = self.beliefs[node]
+        return 0 if belief is None else len(belief)
+    
+    def children(self, node):
+        actions, obs = np.nonzero(self.child[node] >= 0)
+        return [(a, o, self.child[node, a, o]) for a, o in zip(actions, obs)]
+    
+    def obs_children(self, node, action):
+        '''
+        observations seen after taking action at node, with their child nodes
+        '''
+        obs = np.flatnonzero(self.child[node, action] >= 0)
+        return obs, self.child[node, action, obs]
+    
+    def summarize(self, node):
+        '''
+        visit statistics of a node and its immediate children, with the
+        children's belief particles, for merging root-parallel searches
+        '''
+        children = {}
+        for a, o, c in self.children(node):
+            belief = self.beliefs[c]
+            children[(a, o)] = {
+                'n': self.n[c],
+                'n_a': self.n_a[c].copy(),
+                'v_a': self.v_a[c].copy(),
+                'belief': belief.arrays() if belief is not None else None
+            }
+
+        return {
+            'n': self.n[node],
+            'n_a': self.n_a[node].copy(),
+            'v_a': self.v_a[node].copy(),
+            'children': children
+        }
+    
+    def merge_summaries(self, node, summaries):
+        '''
+        fold in summaries of searches from this node: counts and values
+        combine as deltas from the node's current statistics, so a node
+        without any of its own takes their totals, and children's belief
+        particles are pooled
+        '''
+        def _merge(idx, sums):
+            base_n, base_n_a, base_v_a = self.n[idx], self.n_a[idx].copy(), self.v_a[idx].copy()
+            total_n_a = base_n_a + sum(s['n_a'] - base_n_a for s in sums)
+            total_v = base_n_a * base_v_a + sum(s['n_a'] * s['v_a'] - base_n_a * base_v_a for s in sums)
+
+            self.n[idx] = base_n + sum(s['n'] - base_n for s in sums)
+            self.n_a[idx] = total_n_a
+            self.v_a[idx] = np.divide(total_v, total_n_a, out=np.zeros(self.n_actions), where=total_n_a > 0)
+
+        _merge(node, summaries)
+
+        all_keys = set(key for s in summaries for key in s['children'])
+        for a, o in all_keys:
+            c = self.get_child(node, a, o)
+            if c < 0:
+                c = self.add_node(node, a, o)
+
+            sums = [s['children'][(a, o)] for s in summaries if (a, o) in s['children']]
+            _merge(c, sums)
+
+            for child_sum in sums:
+                if child_sum['belief'] is not None:
+                    if self.beliefs[c] is None:
+                        self.beliefs[c] = ParticleBelief(self.goal_length, self.max_particles)
+                    self.beliefs[c].add_batch(*child_sum['belief'])
+
+
 class TeacherPomcpAgent(Agent):
     def __init__(self, goal_length, T, bins=10, p_eps=0.05, lookahead_cap=None,
                        student_reward=10, 
                        n_particles=500, gamma=0.9, eps=1e-2, 
-                       explore_factor=1, q_reinv_scale=1.5, q_reinv_prob=0.25) -> None:
+                       explore_factor=1, q_reinv_scale=1.5, q_reinv_prob=0.25,
+                       max_particles=1000, rollout_batch=None, n_jobs=1,
+                       max_nodes=None, prune_policy='lru',
+                       value_cache=False, cache_min_count=30, cache_tol=0.25,
+                       time_budget_ms=None, early_stop_delta=None,
+                       obs_pw_init=None, obs_pw_alpha=0.5,
+                       belief='particle', grid_shape=(21, 10), grid_qr_samples=8, grid_obs_std=1,
+                       verbose=1, stats_path=None) -> None:
         super().__init__()
         self.goal_length = goal_length
         self.T = T
@@ -572,6 +1341,24 @@ class TeacherPomcpAgent(Agent):
         self.student_reward = student_reward
         self.q_reinv_scale = q_reinv_scale
         self.q_reinv_prob = q_reinv_prob
+        self.max_particles = max_particles
+        self.rollout_batch = rollout_batch
+        self.n_jobs = n_jobs
+        self.max_nodes = max_nodes
+        self.prune_policy = prune_policy
+        self.obs_pw_init = obs_pw_init
+        self.obs_pw_alpha = obs_pw_alpha
+        self.belief = belief
+        self.grid_shape = grid_shape
+        self.grid_qr_samples = grid_qr_samples
+        self.grid_obs_std = grid_obs_std
+        self.value_cache = None
+        if value_cache:
+            self.value_cache = RolloutValueCache(goal_length, RolloutValueCache.horizon_for(gamma, eps),
+                                                 p_eps, n_bins=bins, min_count=cache_min_count, tol=cache_tol)
+        self.budget = SearchBudget(time_budget_ms, early_stop_delta, value_range=student_reward)
+        self.log = SearchLog(verbose, stats_path)
+        self.stats = SearchStats()
 
         self.n_particles = n_particles
         self.gamma = gamma
@@ -580,7 +1367,14 @@ class TeacherPomcpAgent(Agent):
 
         self.actions = [0, 1, 2]
         self.history = ()
-        self.tree = {}
+        self.tree = self._init_tree()
+        self.grid = self._init_grid()
+
+        # with n_jobs > 1, workers keep their own trees and reroot them by
+        # root_key, the (action, observation) the main tree last moved along
+        self.workers = None
+        self.root_key = None
+        self.root_sample = None
 
         self.curr_n = 1
         self.qrs_means = []
@@ -595,38 +1389,74 @@ class TeacherPomcpAgent(Agent):
     
     def reset(self):
         self.history = ()
-        self.tree = {}
+        self.tree = self._init_tree()
+        self.grid = self._init_grid()
+        self.root_key = None
+        if self.workers != None:
+            self.workers.reset()
 
         self.qrs_means = []
         self.qrs_stds = []
         self.num_particles = []
         self.curr_n = 1
     
+    def close(self):
+        if self.workers != None:
+            self.workers.close()
+            self.workers = None
+    
+    def _get_workers(self):
+        if self.workers == None:
+            # workers get the search settings, not the tree, belief or log
+            agent = copy.copy(self)
+            agent.tree = None
+            agent.grid = None
+            agent.value_cache = None
+            agent.log = SearchLog(verbose=0, keep_stats=False)
+            for name in ('qrs_means', 'qrs_stds', 'qes_means', 'qes_stds', 'lr_means', 'lr_stds',
+                         'num_particles', 'replicas'):
+                setattr(agent, name, [])
+            self.workers = PomcpWorkers(self.n_jobs, agent)
+        return self.workers
+    
 
     def next_action(self, prev_action=None, obs=None):
         if obs != None and prev_action != None:
-            print(f'Observed: {obs}')
+            self.log(2, f'Observed: {obs}')
             self.history += (prev_action, obs,)
 
-            qs = [(state[1], state[2], state[3]) for state in self.tree[self.history]['b']]
-            qrs, qes, lrs = zip(*qs)
-            qrs_mean = np.mean(qrs, axis=0)
-            qrs_std = np.std(qrs, axis=0)
-            qes_mean = np.mean(qes)
-            qes_std = np.std(qes)
-            lr_mean = np.mean(lrs)
-            lr_std = np.std(lrs)
+            root_obs = int(obs)
+            next_root = self.tree.get_child(self.tree.root, prev_action, root_obs)
+            if self.grid != None:
+                # the grid carries the belief, so the tree is only reused when it can be
+                self.grid.update(prev_action, obs, self._sample_transition_batch, self.grid_obs_std)
+                if next_root < 0:
+                    self.tree = self._init_tree()
+                else:
+                    self.tree.reroot(next_root)
+                belief = self.grid
+            else:
+                if next_root < 0 and self.obs_pw_init != None:
+                    next_root, root_obs = self._nearest_obs_child(self.tree.root, prev_action, root_obs)
+                if next_root < 0 or self.tree.n_particles(next_root) == 0:
+                    raise Exception('fail to converge')
+                self.tree.reroot(next_root)
+                belief = self.tree.beliefs[self.tree.root]
+            self.root_key = (prev_action, root_obs)
 
-            self.num_particles.append(len(qrs))
+            qrs_mean, qrs_std, qes_mean, qes_std, lr_mean, lr_std = belief.stats()
+
+            self.num_particles.append(len(belief))
             self.qrs_means.append(qrs_mean)
             self.qrs_stds.append(qrs_std)
             self.qes_means.append(qes_mean)
             self.qes_stds.append(qes_std)
             self.lr_means.append(lr_mean)
             self.lr_stds.append(lr_std)
-            print('N_particles:', len(qrs))
+            self.log(2, 'N_particles:', len(belief))
 
-        a = self._search()
+        a, stats = self._search()
+        self.log.record(stats)
         self.curr_n = np.clip(self.curr_n + a - 1, 1, self.goal_length)  # NOTE: assuming agent follows the proposed action
         return a
     
@@ -669,6 +1499,9 @@ class TeacherPomcpAgent(Agent):
     
     def _sig(self, x):
         return 1 / (1 + np.exp(-np.array(x)))
+    
+    def _logsig(self, x):
+        return -np.log(1 + np.exp(-np.array(x)))
 
     def _to_bin(self, log_p, logit_min=-2, logit_max=2, eps=1e-8):
         logit = log_p - np.log(1 - np.exp(log_p) + eps)
@@ -703,112 +1536,310 @@ class TeacherPomcpAgent(Agent):
             return 1
 
     
-    def _init_node(self):
-        return {'v': 0, 'n': 0, 'b': []}
+    def _init_tree(self):
+        return PomcpTree(len(self.actions), self.bins + 1, self.goal_length, max_particles=self.max_particles)
+    
+    def _init_grid(self):
+        if self.belief == 'particle':
+            return None
+        elif self.belief == 'grid':
+            # axes span the support of _sample_prior
+            n_qe, n_lr = self.grid_shape
+            qe_axis = np.linspace(-5, 5, n_qe)
+            lr_axis = (np.arange(n_lr) + 0.5) / n_lr
+            return GridBelief(self.goal_length, qe_axis, lr_axis, n_qr_samples=self.grid_qr_samples)
+        else:
+            raise ValueError(f'belief type not recognized: {self.belief}')
     
     def _search(self):
+        start_time = time.perf_counter()
+        self.stats = SearchStats()
+        self.budget.start()
+
+        states = self._sample_root_states(self.n_particles)
         if len(self.history) == 0:
-            for _ in range(self.n_particles):
-                state = self._sample_prior()
-                self._simulate(state, self.history, 0)
+            self._dispatch_simulations(states)
         else:
-            params = [(state[2], state[3]) for state in self.tree[self.history]['b']]
-            eps, lr = zip(*params)
-            eps_bounds = (np.min(eps), np.max(eps))
-            lr_bounds = (np.min(lr), np.max(lr))
-
-            print('ITER WITH HIST', self.history)
-            iters = []
-            vict_iters = []
-            for _ in range(self.n_particles):
-                state_idx = np.random.choice(len(self.tree[self.history]['b']))
-                state = self.tree[self.history]['b'][state_idx]
-
-                if np.random.random() < self.q_reinv_prob:
-                    new_eps = np.random.uniform(*eps_bounds)
-                    new_lr = np.random.uniform(*lr_bounds)
-                    state = (state[0], state[1], new_eps, new_lr)
-
-                tot_iter, vict_iter = self._simulate(state, self.history, 0)
-                iters.append(tot_iter)
-                vict_iters.append(vict_iter)
+            self.log(2, 'ITER WITH HIST', self.history)
+            iters, vict_iters = self._dispatch_simulations(states)
 
-            print('MEAN ITERS', np.mean(iters))
-            print('N_ITERS', len(iters))
+            self.log(2, 'MEAN ITERS', np.mean(iters))
+            self.log(2, 'N_ITERS', len(iters))
             # print('PROP VICT', np.mean(vict_iters))
         
-        vals = [self.tree[self.history + (a,)]['v'] for a in self.actions]
-        print('VALS', vals)
-        return np.argmax(vals)
+        vals = self.tree.v_a[self.tree.root]
+        self.log(2, 'VALS', list(vals))
+
+        n_nodes = len(self.tree)
+        if self.workers != None:
+            n_nodes = self.workers.n_nodes
+        stats = self.stats.finish(start_time,
+                                  n_nodes=n_nodes,
+                                  n_particles=self.tree.n_particles(self.tree.root))
+        return np.argmax(vals), stats
+    
+    def _sample_root_states(self, size):
+        if self.root_sample is not None:
+            # worker processes only see the states the main process drew
+            idxs = np.random.randint(len(self.root_sample), size=size)
+            return [self.root_sample[i] for i in idxs]
+
+        if self.grid != None:
+            return [self.grid.get(idx) for idx in self.grid.sample_idxs(size)]
+
+        if len(self.history) == 0:
+            return [self._sample_prior() for _ in range(size)]
+
+        belief = self.tree.beliefs[self.tree.root]
+        qes = belief.qe[:len(belief)]
+        lrs = belief.lr[:len(belief)]
+
+        state_idxs = belief.sample_idxs(size)
+        reinv = np.random.random(size) < self.q_reinv_prob
+        new_eps = np.random.uniform(np.min(qes), np.max(qes), size=size)
+        new_lr = np.random.uniform(np.min(lrs), np.max(lrs), size=size)
+
+        states = []
+        for i, state_idx in enumerate(state_idxs):
+            state = belief.get(state_idx)
+            if reinv[i]:
+                state = (state[0], state[1], new_eps[i], new_lr[i])
+            states.append(state)
+        
+        return states
+    
+    def _iter_root_states(self, states):
+        yield from states
+
+        # under a time budget, keep drawing root states until the deadline
+        if self.budget.time_budget_ms != None:
+            while True:
+                yield from self._sample_root_states(self.n_particles)
+    
+    def _is_search_done(self):
+        root = self.tree.root
+        return self.budget.should_stop(self.tree.n_a[root], self.tree.v_a[root])
+
+    def _dispatch_simulations(self, states):
+        if self.n_jobs == 1:
+            return self._run_simulations(states)
+
+        results = self._get_workers().search([{
+            'key': self.root_key,
+            'states': states[i::self.n_jobs],
+            'budget': self.budget,
+            'value_cache': self.value_cache
+        } for i in range(self.n_jobs)])
+
+        # the workers hold everything below the root, so the main tree is
+        # rebuilt to one level from their totals
+        root_belief = self.tree.beliefs[self.tree.root]
+        self.tree = self._init_tree()
+        self.tree.beliefs[self.tree.root] = root_belief
+        self.tree.merge_summaries(self.tree.root, [r['summary'] for r in results])
+        for r in results:
+            self.stats.absorb(r['stats'])
+        if self.value_cache != None:
+            self.value_cache.merge([r['value_cache'] for r in results])
+        iters = [i for r in results for i in r['iters']]
+        vict_iters = [i for r in results for i in r['vict_iters']]
+        return iters, vict_iters
+    
+    def _run_simulations(self, states):
+        iters = []
+        vict_iters = []
+
+        root_states = self._iter_root_states(states)
+        if self.rollout_batch == None:
+            for state in root_states:
+                tot_iter, vict_iter = self._simulate(state, self.tree.root, 0)
+                iters.append(tot_iter)
+                vict_iters.append(vict_iter)
+                self._enforce_node_budget()
+
+                if self._is_search_done():
+                    break
+            return iters, vict_iters
+
+        # NOTE: leaves within a batch are rolled out together, so later tree
+        # descents in the batch do not see the rollout values of earlier ones
+        while True:
+            batch = list(itertools.islice(root_states, self.rollout_batch))
+            if len(batch) == 0:
+                break
+
+            pending = []
+            for state in batch:
+                path = self._descend(state, self.tree.root, 0)
+                pending.append(path)
+                iters.append(path['tot_iter'])
+                vict_iters.append(path['vict_iter'])
+
+            leaves = [path for path in pending if path['leaf'] != None]
+            if len(leaves) > 0:
+                start_time = time.perf_counter()
+                leaf_states, leaf_depths = zip(*[path['leaf'] for path in leaves])
+                pred_rewards = self._rollout_batch(leaf_states, leaf_depths)
+                for path, pred_reward in zip(leaves, pred_rewards):
+                    path['rewards'].append(pred_reward)
+                self.stats.rollout_time += time.perf_counter() - start_time
+            
+            for path in pending:
+                self._backup(path)
+            self._enforce_node_budget()
+
+            if self._is_search_done():
+                break
+
+        return iters, vict_iters
+    
+    def _enforce_node_budget(self):
+        # NOTE: prune to 3/4 of the budget so eviction is not triggered every
+        # simulation, but never below the root and its children, which the
+        # next decision descends into
+        if self.max_nodes != None and len(self.tree) > self.max_nodes:
+            min_nodes = 1 + len(self.tree.children(self.tree.root))
+            self.tree.prune(max(int(0.75 * self.max_nodes), min_nodes), policy=self.prune_policy)
+    
+    def _select_action(self, node):
+        n = self.tree.n[node]
+        n_a = self.tree.n_a[node]
+
+        if n > 0:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                explore = self.explore_factor * np.sqrt(np.log(n) / n_a)
+            explore[n_a == 0] = 999  # arbitrarily high
+        else:
+            explore = np.full(len(n_a), 999)
+
+        return np.argmax(self.tree.v_a[node] + explore)
+    
+    def _simulate(self, state, node, depth):
+        path = self._descend(state, node, depth)
+        if path['leaf'] != None:
+            start_time = time.perf_counter()
+            pred_reward = self._rollout(*path['leaf'])
+            path['rewards'].append(pred_reward)
+            self.stats.rollout_time += time.perf_counter() - start_time
+
+        self._backup(path)
+        return path['tot_iter'], path['vict_iter']
     
-    def _simulate(self, state, history, depth):
+    def _descend(self, state, node, depth):
+        tree = self.tree
         reward_stack = []
         node_stack = []
         n_visited_stack = []
+        leaf = None
 
         tot_iter = 0
         vict_iter = 0
+        is_reused = False
+        tree.tick += 1
 
         while self.gamma ** depth > self.eps:
             tot_iter += 1
-            if history not in self.tree:
-                self.tree[history] = self._init_node()
-                for a in self.actions:
-                    proposal = history + (a,)
-                    self.tree[proposal] = self._init_node()
-                pred_reward = self._rollout(state, history, depth)
-                reward_stack.append(pred_reward)
-                break
-
-            vals = []
-            for a in self.actions:
-                curr_node = self.tree[history]
-                next_node = self.tree[history + (a,)]
-                if curr_node['n'] > 0 and next_node['n'] > 0:
-                    explore = self.explore_factor * np.sqrt(np.log(curr_node['n']) / next_node['n'])
-                else:
-                    explore = 999  # arbitrarily high
-
-                vals.append(next_node['v'] + explore)
+            tree.touch(node)
 
-            a = np.argmax(vals)
+            a = self._select_action(node)
             next_state, obs, reward, is_done = self._sample_transition(state, a)
             reward_stack.append(reward)
 
-            if depth > 0:   # NOTE: avoid re-adding encountered state
-                self.tree[history]['b'].append(state)
-            self.tree[history]['n'] += 1
-
-            next_node = self.tree[history + (a,)]
-            next_node['n'] += 1
-            node_stack.append(next_node)
-            n_visited_stack.append(next_node['n'])
+            if depth > 0 and not is_reused:   # NOTE: avoid re-adding encountered state
+                tree.add_particle(node, state)
+            tree.n[node] += 1
+            tree.n_a[node, a] += 1
+            node_stack.append((node, a))
+            n_visited_stack.append(tree.n_a[node, a])
 
             if is_done:
                 vict_iter = 1
                 break
 
-            history += (a, obs)
             state = next_state
             depth += 1
+
+            next_node = tree.get_child(node, a, int(obs))
+            is_reused = False
+            if next_node < 0 and self._is_obs_saturated(node, a):
+                next_node, state = self._reuse_obs_child(node, a, state)
+                is_reused = True
+
+            if next_node < 0:
+                tree.add_node(node, a, int(obs))
+                if self.gamma ** depth > self.eps:
+                    leaf = (state, depth)
+                break
+
+            node = next_node
         
-        for i, (node, n_visited) in enumerate(zip(node_stack, n_visited_stack)):
+        self.stats.record_depth(tot_iter)
+        return {
+            'nodes': node_stack,
+            'n_visited': n_visited_stack,
+            'rewards': reward_stack,
+            'leaf': leaf,
+            'tot_iter': tot_iter,
+            'vict_iter': vict_iter
+        }
+    
+    def _is_obs_saturated(self, node, a):
+        if self.obs_pw_init == None:
+            return False
+
+        obs, _ = self.tree.obs_children(node, a)
+        cap = np.ceil(self.obs_pw_init * self.tree.n_a[node, a] ** self.obs_pw_alpha)
+        return len(obs) >= cap
+    
+    def _reuse_obs_child(self, node, a, state):
+        '''
+        under observation widening, route a simulation whose observation has no
+        child into an existing child, chosen in proportion to its visits, and
+        continue from one of that child's particles
+        '''
+        _, nodes = self.tree.obs_children(node, a)
+        weights = self.tree.n[nodes] + 1
+        child = np.random.choice(nodes, p=weights / np.sum(weights))
+
+        belief = self.tree.beliefs[child]
+        if belief != None and len(belief) > 0:
+            state = belief.get(belief.sample_idxs(1)[0])
+        return child, state
+    
+    def _nearest_obs_child(self, node, a, obs):
+        all_obs, nodes = self.tree.obs_children(node, a)
+        has_particles = np.array([self.tree.n_particles(c) > 0 for c in nodes], dtype=bool)
+        if not np.any(has_particles):
+            return -1, obs
+
+        all_obs, nodes = all_obs[has_particles], nodes[has_particles]
+        nearest = np.argmin(np.abs(all_obs - obs))
+        self.log(1, f'warn: no child for observation {obs}, continuing from {all_obs[nearest]}')
+        return nodes[nearest], int(all_obs[nearest])
+
+    def _backup(self, path):
+        tree = self.tree
+        reward_stack = path['rewards']
+        for i, ((node, a), n_visited) in enumerate(zip(path['nodes'], path['n_visited'])):
             total_reward = np.sum([r * self.gamma ** iters for iters, r in enumerate(reward_stack[i:])])
-            node['v'] += (total_reward - node['v']) / n_visited
-        
-        return tot_iter, vict_iter
+            tree.v_a[node, a] += (total_reward - tree.v_a[node, a]) / n_visited
 
 
-    def _rollout(self, state, history, depth):
+    def _rollout(self, state, depth):
         g = 1
         total_reward = 0
+        start_state, start_depth = state, depth
 
         while self.gamma ** depth > self.eps:
+            if self.value_cache != None:
+                is_confident, value = self.value_cache.lookup(state[0], self._logsig(state[1] + state[2]), depth)
+                if is_confident[0]:
+                    return total_reward + g * value[0]
+
             # a = self._sample_rollout_policy(history)
             a = self._sample_inc_policy(state)
             state, obs, reward, is_done = self._sample_transition(state, a)
 
-            history += (a, obs)
             total_reward += g * reward
             g *= self.gamma
             depth += 1
@@ -816,383 +1847,489 @@ class TeacherPomcpAgent(Agent):
             if is_done:
                 break
         
+        if self.value_cache != None:
+            self.value_cache.update(start_state[0], self._logsig(start_state[1] + start_state[2]), start_depth, total_reward)
+        return total_reward
+    
+    def _rollout_batch(self, states, depths):
+        n, qr, qe, lr = [np.array(x) for x in zip(*states)]
+        depth = np.array(depths)
+
+        total_reward = np.zeros(len(n))
+        g = np.ones(len(n))
+        active = self.gamma ** depth > self.eps
+        is_cut = np.zeros(len(n), dtype=bool)
+        start_n, start_log_probs = n.copy(), self._logsig(qr + qe.reshape(-1, 1))
+        start_depth = depth.copy()
+
+        while np.any(active):
+            if self.value_cache != None:
+                idxs = np.flatnonzero(active)
+                is_confident, value = self.value_cache.lookup(
+                    n[idxs], self._logsig(qr[idxs] + qe[idxs].reshape(-1, 1)), depth[idxs])
+                cut_idxs = idxs[is_confident]
+                total_reward[cut_idxs] += g[cut_idxs] * value[is_confident]
+                active[cut_idxs] = False
+                is_cut[cut_idxs] = True
+
+                if not np.any(active):
+                    break
+
+            idxs = np.flatnonzero(active)
+            a = self._sample_inc_policy_batch(n[idxs], qr[idxs], qe[idxs])
+            new_n, new_qr, _, reward, is_done = self._sample_transition_batch(
+                n[idxs], qr[idxs], qe[idxs], lr[idxs], a)
+
+            n[idxs] = new_n
+            qr[idxs] = new_qr
+            total_reward[idxs] += g[idxs] * reward
+            g[idxs] *= self.gamma
+            depth[idxs] += 1
+            active[idxs] = ~is_done & (self.gamma ** depth[idxs] > self.eps)
+        
+        if self.value_cache != None:
+            self.value_cache.update(start_n[~is_cut], start_log_probs[~is_cut], start_depth[~is_cut],
+                                    total_reward[~is_cut])
         return total_reward
+    
+    def _sample_transition_batch(self, n, qr, qe, lr, action):
+        new_n = np.clip(n + action - 1, 1, self.goal_length)
+        in_task = np.arange(self.goal_length) < new_n.reshape(-1, 1)
+
+        for _ in range(self.T):
+            fails = (self._sig(qr + qe.reshape(-1, 1)) < np.random.random(qr.shape)) & in_task
+            fail_idx = np.where(np.any(fails, axis=1), np.argmax(fails, axis=1), new_n)
+            qr = self._update_qr_batch(new_n, qr, qe, lr, fail_idx)
+        
+        log_probs = -np.log(1 + np.exp(-(qr + qe.reshape(-1, 1))))
+        is_done = (-np.sum(log_probs, axis=1) < self.p_eps) & (new_n == self.goal_length)
+        reward = np.where(is_done, 10, 0)
+
+        log_prob = np.sum(log_probs * in_task, axis=1)
+        obs = self._to_bin(log_prob)
+
+        return new_n, qr, obs, reward, is_done
+    
+    def _update_qr_batch(self, n, qr, qe, lr, fail_idx):
+        exp_q = self._sig(qr + qe.reshape(-1, 1)) * qr
+        target = np.zeros(qr.shape)
+        target[:,:-1] = exp_q[:,1:]
+
+        rows = np.flatnonzero(fail_idx > 0)
+        fail_rows = fail_idx[rows]
+        payoff = np.where(fail_rows == n[rows],
+                          self.student_reward,
+                          exp_q[rows, np.minimum(fail_rows, self.goal_length - 1)])
+        target[rows, fail_rows - 1] = payoff
+
+        is_updated = np.arange(self.goal_length) < fail_idx.reshape(-1, 1)
+        return qr + lr.reshape(-1, 1) * is_updated * (target - qr)
+    
+    def _sample_inc_policy_batch(self, n, qr, qe):
+        log_probs = -np.log(1 + np.exp(-(qr + qe.reshape(-1, 1))))
+        below = np.cumsum(log_probs, axis=1) < -self.p_eps
+        i = np.where(np.any(below, axis=1), np.argmax(below, axis=1), self.goal_length - 1)
+        return np.where(i + 1 < n, 0, np.where(i + 1 > n, 2, 1))
 
 
     def learn(self, *args, **kwargs):
         raise NotImplementedError('TeacherPomcpAgent does not implement method `learn`')
 
 
-class TeacherPomcpAgentClean(Agent):
+class TeacherPomcpAgentClean(TeacherPomcpAgent):
     def __init__(self, goal_length, T, bins=10, p_eps=0.05,
                        student_reward=10, 
                        n_particles=500, gamma=0.9, eps=1e-2, 
-                       explore_factor=1, q_reinv_prob=0.25) -> None:
+                       explore_factor=1, q_reinv_prob=0.25,
+                       max_particles=1000, rollout_batch=None, n_jobs=1,
+                       max_nodes=None, prune_policy='lru',
+                       value_cache=False, cache_min_count=30, cache_tol=0.25,
+                       time_budget_ms=None, early_stop_delta=None,
+                       obs_pw_init=None, obs_pw_alpha=0.5,
+                       belief='particle', grid_shape=(21, 10), grid_qr_samples=8, grid_obs_std=1,
+                       verbose=1, stats_path=None) -> None:
+        super().__init__(goal_length, T, bins=bins, p_eps=p_eps,
+                         student_reward=student_reward,
+                         n_particles=n_particles, gamma=gamma, eps=eps,
+                         explore_factor=explore_factor, q_reinv_prob=q_reinv_prob,
+                         max_particles=max_particles, rollout_batch=rollout_batch,
+                         n_jobs=n_jobs, max_nodes=max_nodes, prune_policy=prune_policy,
+                         value_cache=value_cache, cache_min_count=cache_min_count, cache_tol=cache_tol,
+                         time_budget_ms=time_budget_ms, early_stop_delta=early_stop_delta,
+                         obs_pw_init=obs_pw_init, obs_pw_alpha=obs_pw_alpha,
+                         belief=belief, grid_shape=grid_shape, grid_qr_samples=grid_qr_samples, grid_obs_std=grid_obs_std,
+                         verbose=verbose, stats_path=stats_path)
+    
+
+class PomcpWorkers:
+    '''
+    persistent search processes for TeacherPomcpAgent. Each worker keeps its
+    own tree across decisions, rerooting it by the action and observation the
+    main tree moved along, so only root states and the budget go out and only
+    root-level statistics come back
+    '''
+    def __init__(self, n_jobs, agent) -> None:
+        self.n_nodes = 0
+        self.conns = []
+        self.procs = []
+        for _ in range(n_jobs):
+            conn, child_conn = Pipe()
+            proc = Process(target=_pomcp_worker, args=(child_conn, agent), daemon=True)
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+    
+    def search(self, requests):
+        for conn, request in zip(self.conns, requests):
+            conn.send(('search', request))
+        results = [conn.recv() for conn in self.conns]
+        self.n_nodes = sum(r['n_nodes'] for r in results)
+        return results
+    
+    def reset(self):
+        for conn in self.conns:
+            conn.send(('reset', None))
+        for conn in self.conns:
+            conn.recv()
+    
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for proc in self.procs:
+            proc.join()
+
+
+def _pomcp_worker(conn, agent):
+    np.random.seed()   # reset seed from parent
+    agent.tree = agent._init_tree()
+
+    while True:
+        cmd, arg = conn.recv()
+        if cmd == 'close':
+            break
+
+        elif cmd == 'reset':
+            agent.tree = agent._init_tree()
+            conn.send(None)
+
+        elif cmd == 'search':
+            if arg['key'] != None:
+                next_root = agent.tree.get_child(agent.tree.root, *arg['key'])
+                if next_root < 0:
+                    agent.tree = agent._init_tree()
+                else:
+                    agent.tree.reroot(next_root)
+
+            agent.root_sample = arg['states']
+            agent.budget = arg['budget']
+            agent.value_cache = arg['value_cache']
+            agent.stats = SearchStats()
+            iters, vict_iters = agent._run_simulations(arg['states'])
+            conn.send({
+                'summary': agent.tree.summarize(agent.tree.root),
+                'n_nodes': len(agent.tree),
+                'stats': agent.stats,
+                'value_cache': agent.value_cache,
+                'iters': iters,
+                'vict_iters': vict_iters
+            })
+
+
+class TeacherPerfectKnowledge(Agent):
+    def __init__(self, goal_length, T, p_eps=0.05, 
+                       student_qe=0, student_lr=0.01, student_reward=10, 
+                       n_iters=500, gamma=0.9, eps=1e-2, explore_factor=1,
+                       value_cache=False, cache_min_count=30, cache_tol=0.25,
+                       time_budget_ms=None, early_stop_delta=None,
+                       transition_samples=None, transition_cache_size=10000,
+                       transpositions=False, book_path=None, book_depth=2,
+                       verbose=1, stats_path=None) -> None:
         super().__init__()
         self.goal_length = goal_length
         self.T = T
-        self.bins = bins
         self.p_eps = p_eps
+        self.student_qe = student_qe
+        self.student_lr = student_lr
         self.student_reward = student_reward
-        self.q_reinv_prob = q_reinv_prob
 
-        self.n_particles = n_particles
+        self.n_iters = n_iters
         self.gamma = gamma
         self.eps = eps
         self.explore_factor = explore_factor
+        self.value_cache = None
+        if value_cache:
+            self.value_cache = RolloutValueCache(goal_length, RolloutValueCache.horizon_for(gamma, eps),
+                                                 p_eps, min_count=cache_min_count, tol=cache_tol)
+        self.budget = SearchBudget(time_budget_ms, early_stop_delta, value_range=student_reward)
+        self.log = SearchLog(verbose, stats_path)
+        self.stats = SearchStats()
+
+        self.transition_samples = transition_samples
+        self.transition_cache_size = transition_cache_size
+        self.transition_cache = OrderedDict()
+
+        # NOTE: with transpositions, statistics live on (state, action) edges in
+        # a table keyed by rounded state and are shared by every path reaching it
+        self.transpositions = transpositions
+        self.table = {}
+
+        self.book = None
+        self.book_depth = book_depth
+        self.n_decisions = 0
+        if book_path != None:
+            self.book = OpeningBook(book_path, {
+                'teacher': 'perfect_knowledge',
+                'goal_length': goal_length, 'T': T, 'p_eps': p_eps,
+                'lr': student_lr, 'eps': student_qe, 'reward': student_reward,
+                'gamma': gamma, 'eps_end': eps, 'transpositions': transpositions
+            })
 
-        self.actions = [0, 1, 2]
+        self.actions = np.arange(goal_length) + 1
         self.history = ()
-        self.full_history = ()
-        self.tree = MctsTree()
-
-        self.curr_n = 1
-        self.qrs_means = []
-        self.qrs_stds = []
-        self.qes_means = []
-        self.qes_stds = []
-        self.lr_means = []
-        self.lr_stds = []
-        self.num_particles = []
-    
+        self.tree = {}
     
     def reset(self):
         self.history = ()
-        self.tree = MctsTree()
+        self.tree = {}
+        self.n_decisions = 0
 
         self.qrs_means = []
         self.qrs_stds = []
         self.num_particles = []
-        self.curr_n = 1
     
 
-    def next_action(self, prev_action=None, obs=None):
-        if obs != None and prev_action != None:
-            print(f'Observed: {obs}')
-            self.history += (prev_action, obs,)
-            self.full_history += (prev_action, obs,)
-
-            if self.history not in self.tree or len(self.tree[self.history]['b']) == 0:
-                raise Exception('fail to converge')
-            else:
-                self.tree.reroot(self.history)
-                self.history = self.history[-1:]
-
-                qs = [(state[1], state[2], state[3]) for state in self.tree[self.history]['b']]
-                qrs, qes, lrs = zip(*qs)
-                qrs_mean = np.mean(qrs, axis=0)
-                qrs_std = np.std(qrs, axis=0)
-                qes_mean = np.mean(qes)
-                qes_std = np.std(qes)
-                lr_mean = np.mean(lrs)
-                lr_std = np.std(lrs)
-
-                self.num_particles.append(len(qrs))
-                self.qrs_means.append(qrs_mean)
-                self.qrs_stds.append(qrs_std)
-                self.qes_means.append(qes_mean)
-                self.qes_stds.append(qes_std)
-                self.lr_means.append(lr_mean)
-                self.lr_stds.append(lr_std)
-                print('N_particles:', len(qrs))
-
-        a = self._search()
-        self.curr_n = np.clip(self.curr_n + a - 1, 1, self.goal_length)  # NOTE: assuming agent follows the proposed action
-        return a
-    
-    def _sample_transition(self, state, action):
-        n, qr, qe, lr = state
-        new_n = np.clip(n + action - 1, 1, self.goal_length)
-        for _ in range(self.T):
-            fail_idx = self._sim_fail(new_n, qr + qe)
-            qr = self._update_qr(new_n, qr, qe, lr, fail_idx)
-        
-        reward = 0
-        is_done = False
-        if -np.sum(np.log(self._sig(qr + qe))) < self.p_eps and new_n == self.goal_length:
-            is_done = True
-            reward = 10
+    def next_action(self, prev_action=None, qr=None):
+        if prev_action != None and type(qr) != type(None):
+            qr = self._round(qr)
+            self.history += (prev_action, tuple(qr))
+            if self.transpositions:
+                self.history = self.history[-2:]
+            elif self.history not in self.tree:
+                self.log(1, 'warn: rerooting tree')
+                self.tree = {}
+                self.history = self.history[-2:]
+        else:
+            self.history += (1, tuple(np.zeros(self.goal_length)))
+            self._load_book()
 
-        log_prob = np.sum([-np.log(1 + np.exp(-q)) for q in (qr + qe)[:new_n]])
-        obs = self._to_bin(log_prob)
-        
-        return (new_n, qr, qe, lr), obs, reward, is_done
+        a, stats = self._search()
+        self.log.record(stats)
 
-    def _sim_fail(self, n, qs):
-        for fail_idx, q in enumerate(qs[:n]):
-            if self._sig(q) < np.random.random():
-                return fail_idx
-        
-        return n
+        self.n_decisions += 1
+        if self.book != None and self.n_decisions <= self.book_depth:
+            self._save_book()
+        return a
+    
+    def _load_book(self):
+        if self.book == None:
+            return
 
-    def _update_qr(self, n, qr, qe, lr, fail_idx):
-        qr = np.copy(qr)
-        if fail_idx == n:
-            payoff = self.student_reward
+        entries = self.book.load()
+        if entries != None:
+            if self.transpositions:
+                self.table.update(entries)
+            else:
+                self.tree.update(entries)
+    
+    def _save_book(self):
+        if self.transpositions:
+            # table entries are shared across paths, so each one keeps the
+            # fewest decisions it has been reached in from the opening
+            self.book.save({k: v for k, v in self.table.items() if v['depth'] < self.book_depth})
+            return
+
+        # tree keys are full histories, so only nodes under the opening state qualify
+        opening = (1, tuple(np.zeros(self.goal_length)))
+        if self.history[:2] != opening:
+            return
+
+        max_len = 2 * self.book_depth + 1
+        self.book.save({k: v for k, v in self.tree.items() if k[:2] == opening and len(k) <= max_len})
+    
+    def _round(self, val):
+        return np.round(val, decimals=1)
+    
+    def _sample_transition(self, state, action):
+        if self.transition_samples == None:
+            return self._sample_transition_fresh(state, action)
+
+        key = (state, action)
+        outcomes = self.transition_cache.get(key)
+        if outcomes == None:
+            outcomes = []
+            self.transition_cache[key] = outcomes
+            if len(self.transition_cache) > self.transition_cache_size:
+                self.transition_cache.popitem(last=False)
         else:
-            payoff = self._sig(qr[fail_idx] + qe) * qr[fail_idx]
+            self.transition_cache.move_to_end(key)
         
-        probs = self._sig(qr[1:fail_idx] + qe)
-        rpe = np.append(probs * qr[1:fail_idx], payoff) - qr[:fail_idx]
-        qr[:fail_idx] += lr * rpe
-        return qr
+        if len(outcomes) < self.transition_samples:
+            outcome = self._sample_transition_fresh(state, action)
+            outcomes.append(outcome)
+            return outcome
+
+        return outcomes[np.random.randint(len(outcomes))]
     
-    def _sig(self, x):
-        return 1 / (1 + np.exp(-np.array(x)))
+    def _sample_transition_fresh(self, state, action):
+        n = action
+        qr = self._student_learn(state, n)
 
-    def _to_bin(self, log_p, logit_min=-2, logit_max=2, eps=1e-8):
-        logit = log_p - np.log(1 - np.exp(log_p) + eps)
+        is_done = False
+        reward = 0
+        log_success_prob = -sum(math.log(1 + math.exp(-(self.student_qe + q))) for q in qr)
+        if log_success_prob > -self.p_eps and n == self.goal_length:
+            is_done = True
+            reward = 10  # TODO: parameterize
 
-        norm = (logit - logit_min) / (logit_max - logit_min)
-        bin_p = np.clip(np.round(norm * self.bins), 0, self.bins)
-        
-        return bin_p
+        qr = tuple(self._round(qr).tolist())
+        return qr, reward, is_done
 
-    def _sample_prior(self):
-        qr = np.zeros(self.goal_length)
-        qe = np.random.uniform(-5, 5)
-        lr = np.random.uniform(0, 1)
-        return (1, qr, qe, lr) 
+    def _student_learn(self, qr, n):
+        '''
+        T steps of a Student (n_step=1) on BinaryEnv(n), without building either
+        '''
+        qr = list(qr)
+        qe = self.student_qe
+        lr = self.student_lr
+        probs = [1 / (1 + math.exp(-(qe + q))) for q in qr[:n]]
+
+        loc = 0
+        for u in np.random.random(self.T).tolist():
+            if u >= probs[loc]:
+                loc = 0     # failed, episode ends without an update
+                continue
+
+            if loc + 1 == n:
+                qr[loc] += lr * (self.student_reward - qr[loc])
+            else:
+                qr[loc] += lr * (probs[loc + 1] * qr[loc + 1] - qr[loc])
+            probs[loc] = 1 / (1 + math.exp(-(qe + qr[loc])))
+            loc = loc + 1 if loc + 1 < n else 0
+        
+        return qr
 
     def _sample_rollout_policy(self, history):
-        return np.random.choice(self.actions)
+        return np.random.choice(self.actions)   # TODO: use something better?
     
-    def _sample_inc_policy(self, state):
-        n, qr, qe = state[:3]
-        total_log_prob = 0
-        for i, q in enumerate(qr + qe):
-            total_log_prob += np.log(self._sig(q))
-            if total_log_prob < -self.p_eps:
+    def _init_node(self):
+        return {'v': 0, 'n': 0}
+    
+    def _search(self):
+        start_time = time.perf_counter()
+        self.stats = SearchStats()
+        self.budget.start()
+
+        if self.transpositions:
+            return self._search_table(start_time)
+
+        for _ in self.budget.sim_range(self.n_iters):
+            self._simulate(self.history, 0)
+
+            children = [self.tree[self.history + (a,)] for a in self.actions]
+            if self.budget.should_stop([c['n'] for c in children], [c['v'] for c in children]):
                 break
         
-        if i + 1 < n:
-            return 0
-        elif i + 1 > n:
-            return 2
-        else:
-            return 1
+        vals = [self.tree[self.history + (a,)]['v'] for a in self.actions]
+        self.log(2, 'VALS', vals)
 
+        stats = self.stats.finish(start_time, n_nodes=len(self.tree))
+        return np.argmax(vals) + 1, stats
     
-    def _init_node(self):
-        return {'v': 0, 'n': 0, 'b': []}
+    def _search_table(self, start_time):
+        prev_action, state = self.history[-2:]
+        for _ in self.budget.sim_range(self.n_iters):
+            self._simulate_table(state, prev_action, 0)
+
+            entry = self.table[state]
+            if self.budget.should_stop(entry['n_a'], entry['v_a']):
+                break
+        
+        vals = self.table[state]['v_a']
+        self.log(2, 'VALS', list(vals))
+
+        stats = self.stats.finish(start_time, n_nodes=len(self.table))
+        return np.argmax(vals) + 1, stats
+    
+    def _init_entry(self, depth):
+        return {
+            'depth': depth,
+            'n': 0,
+            'n_a': np.zeros(len(self.actions), dtype=int),
+            'v_a': np.zeros(len(self.actions))
+        }
     
-    def _search(self):
-        if len(self.history) == 0:
-            for _ in range(self.n_particles):
-                state = self._sample_prior()
-                self._simulate(state, self.history, 0)
+    def _select_table_action(self, entry):
+        n_a = entry['n_a']
+        if entry['n'] > 0:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                explore = self.explore_factor * np.sqrt(np.log(entry['n']) / n_a)
+            explore[n_a == 0] = 999  # arbitrarily high
         else:
-            curr_states = self.tree[self.history]['b']
-
-            params = [(state[2], state[3]) for state in curr_states]
-            eps, lr = zip(*params)
-            eps_bounds = (np.min(eps), np.max(eps))
-            lr_bounds = (np.min(lr), np.max(lr))
-
-            print('ITER WITH HIST', self.full_history)
-            iters = []
-            vict_iters = []
-            for _ in range(self.n_particles):
-                state_idx = np.random.choice(len(curr_states))
-                state = curr_states[state_idx]
-
-                if np.random.random() < self.q_reinv_prob:
-                    new_eps = np.random.uniform(*eps_bounds)
-                    new_lr = np.random.uniform(*lr_bounds)
-                    state = (state[0], state[1], new_eps, new_lr)
-
-                tot_iter, vict_iter = self._simulate(state, self.history, 0)
-                iters.append(tot_iter)
-                vict_iters.append(vict_iter)
+            explore = np.full(len(n_a), 999)
 
-            print('MEAN ITERS', np.mean(iters))
-            print('N_ITERS', len(iters))
-            # print('PROP VICT', np.mean(vict_iters))
-        
-        children = self.tree._traverse(self.history).children
-        vals = [children[a].value['v'] for a in self.actions]
-        print('VALS', vals)
-        return np.argmax(vals)
+        return np.argmax(entry['v_a'] + explore)
     
-    def _simulate(self, state, history, depth):
+    def _simulate_table(self, state, prev_action, depth):
         reward_stack = []
-        node_stack = []
+        edge_stack = []
         n_visited_stack = []
 
-        tot_iter = 0
-        vict_iter = 0
-
+        tree_depth = 0
         while self.gamma ** depth > self.eps:
-            tot_iter += 1
-
-            if history not in self.tree:
-                new_node = MctsNode(self._init_node())
-                new_node.children = {a: MctsNode(self._init_node()) for a in self.actions}
-                curr_node = self.tree._traverse(history[:-1])
+            if state not in self.table:
+                self.table[state] = self._init_entry(self.n_decisions + tree_depth)
 
-                if len(history) > 0:
-                    curr_node.children[history[-1]] = new_node
-                else:
-                    self.tree.root = new_node
-
-                pred_reward = self._rollout(state, history, depth)
+                start_time = time.perf_counter()
+                pred_reward = self._rollout((prev_action, state), depth)
                 reward_stack.append(pred_reward)
+                self.stats.rollout_time += time.perf_counter() - start_time
                 break
 
-            vals = []
-            curr_node = self.tree._traverse(history)
-            for a in self.actions:
-                next_node = curr_node.children[a].value
-                if curr_node.value['n'] > 0 and next_node['n'] > 0:
-                    explore = self.explore_factor * np.sqrt(np.log(curr_node.value['n']) / next_node['n'])
-                else:
-                    explore = 999  # arbitrarily high
-
-                vals.append(next_node['v'] + explore)
-
-            a = np.argmax(vals)
-            next_state, obs, reward, is_done = self._sample_transition(state, a)
+            entry = self.table[state]
+            entry['depth'] = min(entry['depth'], self.n_decisions + tree_depth)
+            a_idx = self._select_table_action(entry)
+            a = self.actions[a_idx]
+            next_state, reward, is_done = self._sample_transition(state, a)
             reward_stack.append(reward)
 
-            if depth > 0:   # NOTE: avoid re-adding encountered state
-                curr_node.value['b'].append(state)
-            curr_node.value['n'] += 1
-
-            next_node = curr_node.children[a].value
-            next_node['n'] += 1
-            node_stack.append(next_node)
-            n_visited_stack.append(next_node['n'])
+            entry['n'] += 1
+            entry['n_a'][a_idx] += 1
+            edge_stack.append((entry, a_idx))
+            n_visited_stack.append(entry['n_a'][a_idx])
 
-            if is_done:
-                vict_iter = 1
-                break
-
-            history += (a, obs)
             state = next_state
+            prev_action = a
             depth += 1
-        
-        for i, (node, n_visited) in enumerate(zip(node_stack, n_visited_stack)):
-            total_reward = np.sum([r * self.gamma ** iters for iters, r in enumerate(reward_stack[i:])])
-            node['v'] += (total_reward - node['v']) / n_visited
-        
-        return tot_iter, vict_iter
-
-
-    def _rollout(self, state, history, depth):
-        g = 1
-        total_reward = 0
-
-        while self.gamma ** depth > self.eps:
-            # a = self._sample_rollout_policy(history)
-            a = self._sample_inc_policy(state)
-            state, obs, reward, is_done = self._sample_transition(state, a)
-
-            history += (a, obs)
-            total_reward += g * reward
-            g *= self.gamma
-            depth += 1
+            tree_depth += 1
 
             if is_done:
                 break
-        
-        return total_reward
-    
 
-class TeacherPerfectKnowledge(Agent):
-    def __init__(self, goal_length, T, p_eps=0.05, 
-                       student_qe=0, student_lr=0.01, student_reward=10, 
-                       n_iters=500, gamma=0.9, eps=1e-2, explore_factor=1) -> None:
-        super().__init__()
-        self.goal_length = goal_length
-        self.T = T
-        self.p_eps = p_eps
-        self.student_qe = student_qe
-        self.student_lr = student_lr
-        self.student_reward = student_reward
-
-        self.n_iters = n_iters
-        self.gamma = gamma
-        self.eps = eps
-        self.explore_factor = explore_factor
-
-        self.actions = np.arange(goal_length) + 1
-        self.history = ()
-        self.tree = {}
-    
-    def reset(self):
-        self.history = ()
-        self.tree = {}
-
-        self.qrs_means = []
-        self.qrs_stds = []
-        self.num_particles = []
-    
-
-    def next_action(self, prev_action=None, qr=None):
-        if prev_action != None and type(qr) != type(None):
-            qr = self._round(qr)
-            self.history += (prev_action, tuple(qr))
-            if self.history not in self.tree:
-                print('warn: rerooting tree')
-                self.tree = {}
-                self.history = self.history[-2:]
-        else:
-            self.history += (1, tuple(np.zeros(self.goal_length)))
-
-        a = self._search()
-        return a
-    
-    def _round(self, val):
-        return np.round(val, decimals=1)
-    
-    def _sample_transition(self, state, action):
-        qr = np.array(state)
-        n = action
-
-        student = Student(lr=self.student_lr, q_e=self.student_qe)
-        student.q_r = qr
-        student.learn(BinaryEnv(n, reward=self.student_reward), max_iters=self.T)
-        qr = student.q_r
-
-        is_done = False
-        reward = 0
-        qs = self.student_qe + qr
-        log_trans_probs = -np.log(1 + np.exp(-qs))
-        log_success_prob = np.sum(log_trans_probs)
-        if log_success_prob > -self.p_eps and n == self.goal_length:
-            is_done = True
-            reward = 10  # TODO: parameterize
-
-        qr = tuple(self._round(qr))
-        return qr, reward, is_done
-
-    def _sample_rollout_policy(self, history):
-        return np.random.choice(self.actions)   # TODO: use something better?
-    
-    def _init_node(self):
-        return {'v': 0, 'n': 0}
-    
-    def _search(self):
-        for _ in range(self.n_iters):
-            self._simulate(self.history, 0)
+        self.stats.record_depth(tree_depth)
         
-        vals = [self.tree[self.history + (a,)]['v'] for a in self.actions]
-        print('VALS', vals)
-        return np.argmax(vals) + 1
+        # backprop rewards along the path's edges; an edge revisited within
+        # one simulation is updated once per visit
+        for i, ((entry, a_idx), n_visited) in enumerate(zip(edge_stack, n_visited_stack)):
+            total_reward = np.sum([r * self.gamma ** iters for iters, r in enumerate(reward_stack[i:])])
+            entry['v_a'][a_idx] += (total_reward - entry['v_a'][a_idx]) / n_visited
     
     def _simulate(self, history, depth):
         reward_stack = []
         node_stack = []
         n_visited_stack = []
 
+        tree_depth = 0
         while self.gamma ** depth > self.eps:
             if history not in self.tree:
                 self.tree[history] = self._init_node()
                 for a in self.actions:
                     proposal = history + (a,)
                     self.tree[proposal] = self._init_node()
+
+                start_time = time.perf_counter()
                 pred_reward = self._rollout(history, depth)
                 reward_stack.append(pred_reward)
+                self.stats.rollout_time += time.perf_counter() - start_time
                 break
 
             vals = []
@@ -1208,7 +2345,7 @@ class TeacherPerfectKnowledge(Agent):
 
             a = np.argmax(vals) + 1
             # print('PROPOSED A', a)
-            state = self.history[-1]
+            state = history[-1]
             next_state, reward, is_done = self._sample_transition(state, a)
             reward_stack.append(reward)
 
@@ -1222,10 +2359,12 @@ class TeacherPerfectKnowledge(Agent):
             # print('NEW HIST', history)
             state = next_state
             depth += 1
+            tree_depth += 1
 
             if is_done:
                 break
 
+        self.stats.record_depth(tree_depth)
         
         # backprop rewards
         for i, (node, n_visited) in enumerate(zip(node_stack, n_visited_stack)):
@@ -1238,7 +2377,13 @@ class TeacherPerfectKnowledge(Agent):
         total_reward = 0
 
         state = history[-1]
+        start_n, start_state, start_depth = history[-2], state, depth
         while self.gamma ** depth > self.eps:
+            if self.value_cache != None:
+                is_confident, value = self.value_cache.lookup(history[-2], self._logsig(state), depth)
+                if is_confident[0]:
+                    return total_reward + g * value[0]
+
             a = self._sample_rollout_policy(history)
             state, reward, is_done = self._sample_transition(state, a)
 
@@ -1250,8 +2395,13 @@ class TeacherPerfectKnowledge(Agent):
             if is_done:
                 break
         
+        if self.value_cache != None:
+            self.value_cache.update(start_n, self._logsig(start_state), start_depth, total_reward)
         return total_reward
     
+    def _logsig(self, qr):
+        return -np.log(1 + np.exp(-(np.array(qr) + self.student_qe)))
+    
     def learn(self, env, is_eval=False,
              max_iters=1000, 
              use_tqdm=False, 
@@ -1259,8 +2409,144 @@ class TeacherPerfectKnowledge(Agent):
         raise NotImplementedError('TeacherPerfectKnowledge does not need to learn - it is cosmically perfect')
 
 
+class StateArrayView(MutableMapping):
+    '''
+    dict-style view over a per-state array, keyed by state tuples, for code
+    written against the older dict-backed DP policy and value tables
+    '''
+    def __init__(self, teacher, arr) -> None:
+        self.teacher = teacher
+        self.arr = arr
+    
+    def __getitem__(self, state):
+        return self.arr[self.teacher._state_index(state)]
+    
+    def __setitem__(self, state, val):
+        self.arr[self.teacher._state_index(state)] = val
+    
+    def __delitem__(self, state):
+        raise TypeError('states cannot be removed from a DP table')
+    
+    def __iter__(self):
+        for idx in range(len(self.arr)):
+            yield self.teacher._state_tuple(idx)
+    
+    def __len__(self):
+        return len(self.arr)
+
+
+class DpSweepWorkers:
+    '''
+    persistent worker processes for TeacherPerfectKnowledgeDp, each owning a
+    fixed block of states. Values (double-buffered for Jacobi sweeps) and the
+    policy sit in shared memory, and workers report back only their block's
+    max change or stability
+    '''
+    def __init__(self, teacher, n_jobs) -> None:
+        n = teacher.n_states
+        self.shm = shared_memory.SharedMemory(create=True, size=3 * n * 8)
+        self.values = np.ndarray((2, n), dtype=np.float64, buffer=self.shm.buf)
+        self.policy = np.ndarray(n, dtype=np.int64, buffer=self.shm.buf, offset=2 * n * 8)
+
+        bounds = np.linspace(0, n, n_jobs + 1).astype(int)
+        self.conns = []
+        self.procs = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            conn, child_conn = Pipe()
+            args = (child_conn, self.shm.name, n, lo, hi, teacher.transitions,
+                    teacher.is_goal, teacher.gamma, teacher.reward)
+            proc = Process(target=_dp_sweep_worker, args=args, daemon=True)
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+    
+    def _broadcast(self, cmd, arg=None):
+        for conn in self.conns:
+            conn.send((cmd, arg))
+        return [conn.recv() for conn in self.conns]
+
+    def policy_eval(self, teacher, max_iters, eps):
+        self.values[0] = teacher.value_arr
+        self.policy[:] = teacher.policy_arr
+        self._broadcast('policy')
+
+        src = 0
+        for _ in range(max_iters):
+            max_change = max(self._broadcast('eval', src))
+            src = 1 - src
+            if max_change < eps:
+                break
+
+        teacher.value_arr[:] = self.values[src]
+    
+    def policy_improv(self, teacher):
+        self.values[0] = teacher.value_arr
+        self.policy[:] = teacher.policy_arr
+        is_stable = all(self._broadcast('improv'))
+        teacher.policy_arr[:] = self.policy
+        return is_stable
+    
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for proc in self.procs:
+            proc.join()
+
+        # drop views before releasing the buffer
+        del self.values, self.policy
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _dp_sweep_worker(conn, shm_name, n_states, lo, hi, transitions, is_goal, gamma, reward):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    values = np.ndarray((2, n_states), dtype=np.float64, buffer=shm.buf)
+    policy = np.ndarray(n_states, dtype=np.int64, buffer=shm.buf, offset=2 * n_states * 8)
+
+    blocks = [P[lo:hi] for P in transitions]
+    del transitions
+
+    while True:
+        cmd, arg = conn.recv()
+        if cmd == 'close':
+            break
+
+        elif cmd == 'policy':
+            # fold this block's policy into one matrix, as in _policy_eval
+            rows = [sparse.diags((policy[lo:hi] == a + 1).astype(float)) @ P for a, P in enumerate(blocks)]
+            P_pi = sparse.csr_matrix(sum(rows))
+            P_goal = sparse.csr_matrix(rows[-1] @ sparse.diags(is_goal.astype(float)))
+            conn.send(None)
+
+        elif cmd == 'eval':
+            target = gamma * values[arg]
+            new_value = P_pi @ target + P_goal @ (reward - target)
+            max_change = np.max(np.abs(new_value - values[arg, lo:hi]), initial=0)
+            values[1 - arg, lo:hi] = new_value
+            conn.send(max_change)
+
+        elif cmd == 'improv':
+            target = gamma * values[0]
+            goal_target = np.where(is_goal, reward, target)
+            vals = np.stack([P @ (goal_target if a == len(blocks) - 1 else target) for a, P in enumerate(blocks)])
+            best_a = np.argmax(vals, axis=0) + 1
+            conn.send(bool(np.all(best_a == policy[lo:hi])))
+            policy[lo:hi] = best_a
+    
+    del values, policy
+    shm.close()
+
+
+@lru_cache(maxsize=16)
+def _fail_sequences(n_outcomes, T):
+    '''
+    every sequence of T failure indices drawn from 0..n_outcomes-1
+    '''
+    return np.array(list(itertools.product(range(n_outcomes), repeat=T)))
+
+
 class TeacherPerfectKnowledgeDp(Agent):
-    def __init__(self, goal_length=3, train_iters=50, p_eps=0.05, gamma=0.9, reward=10, n_bins_per_q=100, n_round_places=1, student_params=None) -> None:
+    def __init__(self, goal_length=3, train_iters=50, p_eps=0.05, gamma=0.9, reward=10, n_bins_per_q=100, n_round_places=1, student_params=None, reachable_only=False, eval_iters=3, n_jobs=1, cache_dir=None) -> None:
         super().__init__()
         self.student_params = {
             'lr': 0.1,
@@ -1279,16 +2565,86 @@ class TeacherPerfectKnowledgeDp(Agent):
         self.reward = reward
         self.n_bins_per_q = n_bins_per_q
         self.n_round_places = n_round_places
+        self.eval_iters = eval_iters
+        self.n_jobs = n_jobs
 
         self.state_axis = np.round(
             np.linspace(0, self.student_params['reward'], n_bins_per_q), 
             n_round_places)
-        self.states = self._combo(self.state_axis, self.N)
+        self.axis_idx = {q: i for i, q in enumerate(self.state_axis)}
+        self.strides = n_bins_per_q ** np.arange(self.N - 1, -1, -1)
+        self.n_grid_states = n_bins_per_q ** self.N
+
+        # (action - 1) -> sparse (state, next state) probabilities, built on first use
+        self.transitions = None
+        self.is_goal = None
+
+        # NOTE: with reachable_only, states are compact ids into self.reachable,
+        # the grid indices reachable from qr = 0, rather than grid indices
+        self.reachable = None
+        self.reachable_ids = None
+
+        self.cache_path = None
+        if cache_dir != None:
+            config = {
+                'goal_length': goal_length,
+                'train_iters': train_iters,
+                'p_eps': p_eps,
+                'gamma': gamma,
+                'reward': reward,
+                'n_bins_per_q': n_bins_per_q,
+                'n_round_places': n_round_places,
+                'student_params': self.student_params,
+                'reachable_only': reachable_only,
+                'eval_iters': eval_iters
+            }
+            self.cache_path = os.path.join(cache_dir, f'dp_{_config_hash(config)}')
+
+        self.is_cached = self._load_solution()
+        if not self.is_cached:
+            if reachable_only:
+                self._expand_reachable()
+            self.n_states = len(self.reachable) if reachable_only else self.n_grid_states
+            self.policy_arr = np.random.randint(self.N, size=self.n_states) + 1
+            self.value_arr = np.zeros(self.n_states)
+
+        self.policy = StateArrayView(self, self.policy_arr)
+        self.value = StateArrayView(self, self.value_arr)
+    
+    def _load_solution(self):
+        '''
+        memory-map a solved policy and value from cache_path, if one exists.
+        The mapped arrays are read-only, and shared through the page cache by
+        every process loading the same solution
+        '''
+        if self.cache_path == None or not os.path.exists(self.cache_path):
+            return False
 
-        rand_ints = np.random.randint(self.N, size=len(self.states)) + 1
-        self.policy = {s:a for s, a in zip(self.states, rand_ints)}
-        self.value = {s:0 for s in self.states}
-        
+        self.policy_arr = np.load(os.path.join(self.cache_path, 'policy.npy'), mmap_mode='r')
+        self.value_arr = np.load(os.path.join(self.cache_path, 'value.npy'), mmap_mode='r')
+        self.n_states = len(self.policy_arr)
+
+        reachable_path = os.path.join(self.cache_path, 'reachable.npy')
+        if os.path.exists(reachable_path):
+            self.reachable = np.load(reachable_path)
+            self.reachable_ids = {idx: i for i, idx in enumerate(self.reachable.tolist())}
+        return True
+    
+    def _save_solution(self):
+        # write to a private directory then rename, so concurrent solves of
+        # the same configuration never expose a partial cache entry
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, 'policy.npy'), self.policy_arr)
+        np.save(os.path.join(tmp_path, 'value.npy'), self.value_arr)
+        if self.reachable is not None:
+            np.save(os.path.join(tmp_path, 'reachable.npy'), self.reachable)
+
+        try:
+            os.replace(tmp_path, self.cache_path)
+        except OSError:
+            # another process saved this configuration first
+            shutil.rmtree(tmp_path)
     
     def _combo(self, axis, dims):
         states = [(s,) for s in axis]
@@ -1296,104 +2652,252 @@ class TeacherPerfectKnowledgeDp(Agent):
             states = [ss + (s,) for ss in states for s in axis]
 
         return states
+    
+    def _state_index(self, state):
+        grid_idx = sum(self.axis_idx[q] * stride for q, stride in zip(state, self.strides))
+        return self._to_state(grid_idx)
+    
+    def _state_tuple(self, idx):
+        return tuple(self._state_values(idx))
+    
+    def _state_values(self, idxs):
+        if self.reachable is not None:
+            idxs = self.reachable[idxs]
+        return self._grid_values(idxs)
+    
+    def _grid_values(self, grid_idxs):
+        bins = np.stack(np.unravel_index(grid_idxs, (self.n_bins_per_q,) * self.N), axis=-1)
+        return self.state_axis[bins]
+    
+    def _to_state(self, grid_idx):
+        if self.reachable is None:
+            return grid_idx
+        
+        state = self.reachable_ids.get(int(grid_idx))
+        if state == None:
+            # fall back to the nearest reachable state
+            dists = np.sum((self._grid_values(self.reachable) - self._grid_values(grid_idx)) ** 2, axis=1)
+            state = np.argmin(dists)
+        return state
+    
+    def _disc_index(self, qr):
+        bin_idx = np.round(qr / self.student_params['reward'] * (self.n_bins_per_q - 1)).astype('int')
+        bin_idx = np.clip(bin_idx, 0, self.n_bins_per_q - 1)
+        return bin_idx @ self.strides
 
     def next_action(self, state):
-        state = tuple(self._disc(state))
-        return self.policy[state]
+        return self.policy_arr[self._to_state(self._disc_index(np.array(state)))]
     
-    def learn(self, max_iters=100, eval_iters=3, with_tqdm=True):
+    def learn(self, max_iters=100, with_tqdm=True):
+        if self.is_cached:
+            print(f'info: loaded cached policy from {self.cache_path}')
+            return
+
+        self._get_transitions()
+
         iterator = range(max_iters)
         if with_tqdm:
             iterator = tqdm(iterator)
 
-        for i in iterator:
-            # print('Step', i)
-            self._policy_eval(max_iters=eval_iters)
-            is_stable = self._policy_improv()
+        workers = None
+        if self.n_jobs > 1:
+            workers = DpSweepWorkers(self, self.n_jobs)
 
-            if is_stable:
-                print(f'info: policy converged in {i+1} steps')
-                return
-        
-        print('warn: policy never converged')
+        is_stable = False
+        try:
+            for i in iterator:
+                # print('Step', i)
+                self._policy_eval(max_iters=self.eval_iters, workers=workers)
+                is_stable = self._policy_improv(workers=workers)
+
+                if is_stable:
+                    print(f'info: policy converged in {i+1} steps')
+                    break
+            else:
+                print('warn: policy never converged')
+        finally:
+            if workers != None:
+                workers.close()
+
+        # an unconverged policy depends on max_iters, which the cache key
+        # leaves out, so only a converged one is cached
+        if self.cache_path != None and is_stable:
+            self._save_solution()
     
-    def _policy_eval(self, max_iters=999, eps=1e-2):
+    def _policy_eval(self, max_iters=999, eps=1e-2, workers=None):
+        if workers != None:
+            return workers.policy_eval(self, max_iters, eps)
+
+        transitions = self._get_transitions()
+
+        # NOTE: the policy is fixed here, so fold it into a single transition
+        # matrix, plus a goal matrix carrying the terminal reward
+        rows = [sparse.diags((self.policy_arr == a + 1).astype(float)) @ P for a, P in enumerate(transitions)]
+        P_pi = sparse.csr_matrix(sum(rows))
+        P_goal = sparse.csr_matrix(rows[-1] @ sparse.diags(self.is_goal.astype(float)))
+
         for _ in range(max_iters):
-            max_change = 0
-
-            # print('Eval sweep')
-            # for s in tqdm(self.states):
-            for s in self.states:
-                old_val = self.value[s]
-                new_val = self._compute_value(s, self.policy[s])
-                self.value[s] = new_val
-                max_change = max(max_change, np.abs(old_val - new_val))
+            old_value = self.value_arr.copy()
+            target = self.gamma * old_value
+            self.value_arr[:] = P_pi @ target + P_goal @ (self.reward - target)
             
-            if max_change < eps:
+            if np.max(np.abs(self.value_arr - old_value)) < eps:
                 break
 
-    def _policy_improv(self):
-        is_stable = True
-        # print('Improv sweep')
-        # for s in tqdm(self.states):
-        for s in self.states:
-            old_a = self.policy[s]
-            vals = [self._compute_value(s, a) for a in np.arange(self.N) + 1]
-            best_a = np.argmax(vals) + 1
-            self.policy[s] = best_a
-
-            if best_a != old_a:
-                is_stable = False
-        
+    def _policy_improv(self, workers=None):
+        if workers != None:
+            return workers.policy_improv(self)
+
+        vals = np.stack([self._action_values(a) for a in np.arange(self.N) + 1])
+        best_a = np.argmax(vals, axis=0) + 1
+
+        is_stable = np.all(best_a == self.policy_arr)
+        self.policy_arr[:] = best_a
         return is_stable
-            
     
-    def _compute_value(self, state, action):
-        logprobs = self._compute_prob(state, action)
-        val = 0
-        for next_state, logprob in [(k, v) for k, v in logprobs.items() if v != -np.inf]:
-            state_logprobs = self._logsig(np.array(next_state) + self.student_params['eps'])
-            if action == self.N and -np.sum(state_logprobs) < self.p_eps:
-                update = self.reward
-            else:
-                update = self.gamma * self.value[next_state]
-            val += np.exp(logprob) * update
-        return val
-    
-    def _compute_prob(self, state, action):
-        # logprobs = {s:-np.inf for s in self.states}
-        logprobs = defaultdict(lambda: -np.inf)
-        eps = self.student_params['eps']
-
-        fail_axis = np.arange(action + 1)
-        fails = self._combo(fail_axis, self.T)
+    def _action_values(self, action, idxs=None):
+        P = self._get_transitions()[action - 1]
+        if idxs is not None:
+            P = P[idxs]
 
-        for run in fails:
-            qr = np.array(state)
-            cum_log_prob = 0
-            for fail_idx in run:
-                cum_log_prob += np.sum(self._logsig(qr[:fail_idx] + eps))
-                if fail_idx < action:
-                    cum_log_prob += np.log(1 - self._sig(qr[fail_idx] + eps))
+        target = self.gamma * self.value_arr
+        if action == self.N:
+            target = np.where(self.is_goal, self.reward, target)
+        return P @ target
+    
+    def _compute_value(self, state, action):
+        return self._action_values(action, idxs=[self._state_index(state)])[0]
+    
+    def _get_transitions(self, max_elems=2**22):
+        if self.is_goal is not None:
+            return self.transitions
+
+        # reachable-state transitions are built during expansion, which only
+        # remains to be done here if the solution was loaded from cache
+        if self.transitions == None and self.reachable is not None:
+            self._expand_reachable()
+        elif self.transitions == None:
+            self.transitions = []
+            for action in np.arange(self.N) + 1:
+                chunk_size = self._chunk_size(action, max_elems)
+                blocks = [self._compute_prob(np.arange(start, min(start + chunk_size, self.n_states)), action)
+                          for start in range(0, self.n_states, chunk_size)]
+                self.transitions.append(sparse.vstack(blocks, format='csr'))
 
-                qr = self._update_qr(action, qr, fail_idx)
-            
-            qr = tuple(self._disc(qr))
-            logprobs[qr] = np.logaddexp(logprobs[qr], cum_log_prob)
+        eps = self.student_params['eps']
+        self.is_goal = np.zeros(self.n_states, dtype=bool)
+        chunk_size = max(1, max_elems // self.N)
+        for start in range(0, self.n_states, chunk_size):
+            idxs = np.arange(start, min(start + chunk_size, self.n_states))
+            qs = self._state_values(idxs) + eps
+            self.is_goal[idxs] = -np.sum(self._logsig(qs), axis=1) < self.p_eps
         
-        return logprobs
-
+        return self.transitions
+    
+    def _chunk_size(self, action, max_elems):
+        '''
+        states per chunk, so that the (action + 1)**T failure outcomes of
+        every state, N values each, fit within max_elems
+        '''
+        n_runs = (action + 1) ** self.T
+        return max(1, max_elems // (n_runs * self.N))
+    
+    def _expand_reachable(self, max_elems=2**22):
+        '''
+        breadth-first expansion from qr = 0 under every action, collecting the
+        reachable grid states and the transitions between them
+        '''
+        start = int(self._disc_index(np.zeros(self.N)))
+        self.reachable_ids = {start: 0}
+        frontier = [start]
+        all_edges = [[] for _ in range(self.N)]
+
+        while len(frontier) > 0:
+            new_states = []
+            for action in np.arange(self.N) + 1:
+                chunk_size = self._chunk_size(action, max_elems)
+                for chunk_start in range(0, len(frontier), chunk_size):
+                    src = np.array(frontier[chunk_start:chunk_start + chunk_size])
+                    next_idxs, probs = self._fail_outcomes(self._grid_values(src), action)
+                    rows = np.repeat(src, next_idxs.shape[1])
+                    # NOTE: dedupe (row, col) pairs directly, since packing them
+                    # into one int64 key overflows on large grids
+                    edges, inverse = np.unique(np.stack([rows, next_idxs.flatten()], axis=1),
+                                               axis=0, return_inverse=True)
+                    probs = np.bincount(inverse.ravel(), weights=probs.flatten(), minlength=len(edges))
+                    is_nonzero = probs > 0
+                    rows, cols = edges[is_nonzero].T
+                    all_edges[action - 1].append((rows, cols, probs[is_nonzero]))
+
+                    for idx in np.unique(cols).tolist():
+                        if idx not in self.reachable_ids:
+                            self.reachable_ids[idx] = len(self.reachable_ids)
+                            new_states.append(idx)
+            frontier = new_states
+        
+        self.reachable = np.array(list(self.reachable_ids.keys()))
+        order = np.argsort(self.reachable)
+        sorted_reachable = self.reachable[order]
+
+        def _to_ids(grid_idxs):
+            return order[np.searchsorted(sorted_reachable, grid_idxs)]
+
+        n_reachable = len(self.reachable)
+        self.transitions = []
+        for edges in all_edges:
+            rows, cols, probs = [np.concatenate(x) for x in zip(*edges)]
+            P = sparse.csr_matrix((probs, (_to_ids(rows), _to_ids(cols))), shape=(n_reachable, n_reachable))
+            self.transitions.append(P)
+    
+    def _compute_prob(self, idxs, action):
+        '''
+        transition probabilities from the states at idxs under action, as a
+        sparse (len(idxs), n_states) block
+        '''
+        next_idxs, probs = self._fail_outcomes(self._state_values(idxs), action)
+
+        rows = np.repeat(np.arange(len(idxs)), next_idxs.shape[1])
+        block = sparse.csr_matrix((probs.flatten(), (rows, next_idxs.flatten())),
+                                  shape=(len(idxs), self.n_states))
+        block.eliminate_zeros()
+        return block
+    
+    def _fail_outcomes(self, qr, action):
+        '''
+        follow every sequence of T failure indices from each row of qr at once,
+        returning the grid index each sequence lands in and its probability.
+        Sequences landing in the same bin are summed by the caller
+        '''
+        eps = self.student_params['eps']
+        fails = _fail_sequences(action + 1, self.T)
+        n_runs = len(fails)
+
+        qr = np.repeat(qr[:,np.newaxis,:], n_runs, axis=1)
+        log_probs = np.zeros(qr.shape[:2])
+        for t in range(self.T):
+            fail_idx = np.broadcast_to(fails[:,t], log_probs.shape)
+            logsig = self._logsig(qr + eps)
+            cum_logsig = np.concatenate((np.zeros(log_probs.shape + (1,)), np.cumsum(logsig, axis=-1)), axis=-1)
+            log_probs += np.take_along_axis(cum_logsig, fail_idx[...,np.newaxis], axis=-1)[...,0]
+
+            is_fail = fail_idx < action
+            q_fail = np.take_along_axis(qr, np.minimum(fail_idx, self.N - 1)[...,np.newaxis], axis=-1)[...,0]
+            log_probs += np.where(is_fail, self._logsig(-(q_fail + eps)), 0)
+
+            qr = self._update_qr(action, qr, fail_idx)
+        
+        return self._disc_index(qr), np.exp(log_probs)
 
     def _update_qr(self, n, qr, fail_idx):
-        if fail_idx == n:
-            payoff = self.student_params['reward']
-        else:
-            payoff = self._sig(qr[fail_idx] + self.student_params['eps']) * qr[fail_idx]
-        
-        probs = self._sig(qr[1:fail_idx] + self.student_params['eps'])
-        rpe = np.append(probs * qr[1:fail_idx], payoff) - qr[:fail_idx]
-        qr[:fail_idx] += self.student_params['lr'] * rpe
-        return qr
+        exp_q = self._sig(qr + self.student_params['eps']) * qr
+        target = np.zeros(qr.shape)
+        target[...,:-1] = exp_q[...,1:]
+
+        is_last = np.arange(self.N) == (fail_idx[...,np.newaxis] - 1)
+        target = np.where(is_last & (fail_idx[...,np.newaxis] == n), self.student_params['reward'], target)
+
+        is_updated = np.arange(self.N) < fail_idx[...,np.newaxis]
+        return qr + self.student_params['lr'] * is_updated * (target - qr)
     
     def _sig(self, val):
         return 1 / (1 + np.exp(-val))
@@ -1413,13 +2917,18 @@ class MctsTree:
     def __init__(self) -> None:
         self.root = MctsNode(None)
     
+    def _find(self, key):
+        node = self.root
+        for k in key:
+            node = node.children.get(k)
+            if node is None:
+                return None
+        return node
+    
     def _traverse(self, key):
-        if len(key) == 0:
-            return self.root
-
-        node = self.root[key[0]]
-        for k in key[1:]:
-            node = node[k]
+        node = self._find(key)
+        if node is None:
+            raise KeyError(key)
         return node
         
     def __getitem__(self, key):
@@ -1427,20 +2936,32 @@ class MctsTree:
     
     def __setitem__(self, key, value):
         node = self._traverse(key[:-1])
-        if node[key[-1]] != None:
+        if node[key[-1]] is not None:
             node[key[-1]].value = value
         else:
             node[key[-1]] = MctsNode(value)
     
     def __contains__(self, key):
-        if len(key) == 0 and self.root.value == None:
+        node = self._find(key)
+        if node is None:
             return False
-
-        try:
-            node = self._traverse(key)
-        except:
-            return False
-        return node != None
+        return len(key) > 0 or node.value is not None
+    
+    def __len__(self):
+        '''
+        number of valued nodes in the tree
+        '''
+        size = 0
+        frontier = [self.root]
+        while len(frontier) > 0:
+            node = frontier.pop()
+            if node.value is not None:
+                size += 1
+            frontier.extend(node.children.values())
+        return size
+    
+    def cursor(self, key=()):
+        return MctsCursor(self, key)
     
     def reroot(self, key):
         new_root = self._traverse(key)
@@ -1450,6 +2971,33 @@ class MctsTree:
     def merge(self, other, merge_func):
         self.root.merge(other.root, merge_func)
     
+    def summarize(self, depth):
+        '''
+        flat map from key to node value, for every valued node with a key of
+        length up to depth
+        '''
+        summary = {}
+        frontier = [((), self.root)]
+        while len(frontier) > 0:
+            key, node = frontier.pop()
+            if node.value is not None:
+                summary[key] = node.value
+            if len(key) < depth:
+                frontier.extend((key + (k,), child) for k, child in node.children.items())
+        return summary
+    
+    @staticmethod
+    def from_summary(summary):
+        tree = MctsTree()
+        for key, value in summary.items():
+            node = tree.root
+            for k in key:
+                if node[k] is None:
+                    node[k] = MctsNode(None)
+                node = node[k]
+            node.value = value
+        return tree
+    
     def __str__(self):
         return str(self.root)
     
@@ -1457,28 +3005,65 @@ class MctsTree:
         return str(self)
 
 
+class MctsCursor:
+    '''
+    position in an MctsTree that descends one key at a time, so a simulation
+    walks its path once rather than from the root on every access. The path
+    holds every node passed through, with None past the edge of the tree
+    '''
+    def __init__(self, tree, key=()) -> None:
+        self.path = [tree.root]
+        self.keys = []
+        for k in key:
+            self.descend(k)
+    
+    @property
+    def node(self):
+        return self.path[-1]
+    
+    def descend(self, key, create=False):
+        node = self.path[-1]
+        child = None if node is None else node.children.get(key)
+        if child is None and create:
+            child = MctsNode(None)
+            node.children[key] = child
+
+        self.path.append(child)
+        self.keys.append(key)
+        return child
+    
+    def expand(self, value):
+        '''
+        create the node at the cursor, whose parent must already exist
+        '''
+        parent = self.path[-2]
+        if parent is None:
+            raise KeyError(tuple(self.keys[:-1]))
+
+        self.path[-1] = MctsNode(value)
+        parent.children[self.keys[-1]] = self.path[-1]
+        return self.path[-1]
+
+
 class MctsNode:
     def __init__(self, value) -> None:
         self.value = value
         self.children = {}
     
     def __getitem__(self, key):
-        if key not in self.children:
-            return None
-
-        return self.children[key]
+        return self.children.get(key)
     
     def __setitem__(self, key, node):
         self.children[key] = node
 
     def __eq__(self, other):
-        if other == None:
+        if other is None:
             return False
 
         return self.value == other.value
     
     def merge(self, other, merge_func):
-        if self.value != None and other.value != None:
+        if self.value is not None and other.value is not None:
             self.value = merge_func(self.value, other.value)
 
         for key, child in other.children.items():
@@ -1509,8 +3094,42 @@ class MctsNode:
 # tree.merge(tree2, lambda a,b: a + b)
 # print(str(tree))
 
+class MctsContWorkers:
+    '''
+    persistent search processes for TeacherMctsCont. Each worker keeps its
+    own tree across decisions, rerooting it locally, so only per-decision
+    settings go out and only root action statistics come back
+    '''
+    def __init__(self, n_jobs, params) -> None:
+        self.conns = []
+        self.procs = []
+        for _ in range(n_jobs):
+            conn, child_conn = Pipe()
+            proc = Process(target=_mcts_worker, args=(child_conn, params), daemon=True)
+            proc.start()
+            self.conns.append(conn)
+            self.procs.append(proc)
+    
+    def _broadcast(self, cmd, arg=None):
+        for conn in self.conns:
+            conn.send((cmd, arg))
+        return [conn.recv() for conn in self.conns]
+    
+    def search(self, request):
+        return self._broadcast('search', request)
+    
+    def reset(self):
+        self._broadcast('reset')
+    
+    def close(self):
+        for conn in self.conns:
+            conn.send(('close', None))
+        for proc in self.procs:
+            proc.join()
+
+
 class TeacherMctsCont(Agent):
-    def __init__(self, N_eff, update_width=100, T=5, threshold=0.95, bandwidth=10, student_params=None, n_iters=1000, gamma=0.9, pw_init=5, pw_alpha=0.8, explore_factor=1, n_jobs=16) -> None:
+    def __init__(self, N_eff, update_width=100, T=5, threshold=0.95, bandwidth=10, student_params=None, n_iters=1000, gamma=0.9, pw_init=5, pw_alpha=0.8, explore_factor=1, action_bins=None, bin_pw_alpha=0.5, n_jobs=16, rollout_batch=None, value_cache=False, cache_min_count=30, cache_tol=0.25, time_budget_ms=None, early_stop_delta=None, book_path=None, book_depth=2, verbose=1, stats_path=None) -> None:
         super().__init__()
         self.N_eff = N_eff
         self.T = T
@@ -1532,15 +3151,38 @@ class TeacherMctsCont(Agent):
         self.pw_init = pw_init
         self.pw_alpha = pw_alpha
         self.explore_factor = explore_factor
+        self.action_bins = action_bins
+        self.bin_pw_alpha = bin_pw_alpha
         self.n_jobs = n_jobs
+        self.rollout_batch = rollout_batch
+        self.eps_end = 0.01
+        self.log = SearchLog(verbose, stats_path)
 
         self.N, self.eps = TeacherMctsCont._to_cont(self.N_eff, self.student_params['eps_eff'])
+        self.value_cache = None
+        if value_cache:
+            self.value_cache = RolloutValueCache(self.N, RolloutValueCache.horizon_for(self.gamma, self.eps_end),
+                                                 track_n=False, min_count=cache_min_count, tol=cache_tol)
+        self.budget = SearchBudget(time_budget_ms, early_stop_delta, value_range=self.student_params['reward'])
         self.actions = np.arange(self.N) + 1
         self.actions_rand = np.random.permutation(self.N-1) + 1
         self.actions_rand = np.append(self.N, self.actions_rand)  # ensure goal length is always present
 
+        self.book = None
+        self.book_depth = book_depth
+        self.is_opening = False
+        if book_path != None:
+            self.book = OpeningBook(book_path, {
+                'teacher': 'mcts_cont',
+                'node_format': 'quantized_keys',
+                'action_bins': action_bins,
+                'N_eff': N_eff, 'T': T, 'update_width': update_width,
+                'threshold': threshold, 'gamma': gamma,
+                'student_params': self.student_params
+            })
+
         self.history = ()
-        self.tree = MctsTree()
+        self.workers = None
 
     @staticmethod
     def _to_cont(N_eff, eps_eff, dn_per_interval=100):
@@ -1552,97 +3194,208 @@ class TeacherMctsCont(Agent):
 
     def reset(self):
         self.history = ()
-        self.tree = MctsTree()
+        if self.workers != None:
+            self.workers.reset()
+    
+    def close(self):
+        if self.workers != None:
+            self.workers.close()
+            self.workers = None
+    
+    def _get_workers(self):
+        if self.workers == None:
+            self.workers = MctsContWorkers(self.n_jobs, {
+                'bandwidth': self.bandwidth,
+                'n_particles': self.n_iters,
+                'N_cont': self.N,
+                'eps_cont': self.eps,
+                'threshold': self.threshold,
+                'T': self.T,
+                'lr': self.student_params['lr'],
+                'update_width': self.update_width,
+                'gamma': self.gamma,
+                'eps_end': self.eps_end,
+                'explore_factor': 1,
+                'rollout_batch': self.rollout_batch,
+                'action_bins': self.action_bins,
+                'bin_pw_alpha': self.bin_pw_alpha,
+            })
+        return self.workers
     
     def next_action(self, prev_action=None, qr=None):
         self.iter += 1
 
+        # workers reroot their own trees by the key
+        key = None
+        book_tree = None
+        self.is_opening = False
         if prev_action != None and type(qr) != None:
-            qr = self._round(qr)
-            self.history += (prev_action, tuple(self._round(qr)))
-            if self.history not in self.tree:
-                print('warn: rerooting tree')
-                self.tree = MctsTree()
-                self.history = self.history[-1:]
-            else:
-                self.tree.reroot(self.history)
-                self.history = self.history[-1:]
+            key = self.history + (prev_action, _qr_key(qr))
+            self.history = key[-1:]
         else:
-            self.history = (tuple(np.zeros(self.N)),)
+            self.history = (_qr_key(np.zeros(self.N)),)
+            self.is_opening = True
+            if self.book != None:
+                book_tree = self.book.load()
+                if book_tree is None:
+                    book_tree = MctsTree()
             
-        print('ITER', self.iter)
+        start_time = time.perf_counter()
+        self.log(2, 'ITER', self.iter)
         pw_size = np.ceil(self.pw_init * (self.iter) ** self.pw_alpha).astype(int)
         actions = self.actions_rand[:pw_size]
 
-        print('PW_SIZE', pw_size)
-        print('ACTIONS', actions)
+        self.log(2, 'PW_SIZE', pw_size)
+        self.log(2, 'ACTIONS', actions)
 
-        args = {
-            'tree': self.tree,
+        is_book_saved = self.book != None and self.is_opening
+        results = self._get_workers().search({
+            'key': key,
+            'book_tree': book_tree,
             'history': self.history,
-            'bandwidth': self.bandwidth,
             'actions': actions,
-            'n_particles': self.n_iters,
-            'N_cont': self.N,
-            'eps_cont': self.eps,
-            'threshold': self.threshold,
-            'T': self.T,
-            'lr': self.student_params['lr'],
-            'update_width': self.update_width,
-            'gamma': self.gamma,
-            'eps_end': 0.01,
-            'explore_factor': 1
-        }
-
-        # all_args = [copy.deepcopy(args) for _ in range(self.n_jobs)]
-        all_args = [args for _ in range(self.n_jobs)]
+            'value_cache': self.value_cache,
+            'budget': self.budget.start(),
+            'book_depth': self.book_depth if is_book_saved else None
+        })
+        if any(r['is_rerooted'] for r in results):
+            self.log(1, 'warn: rerooting tree')
+        if self.value_cache != None:
+            self.value_cache.merge([r['value_cache'] for r in results])
 
-        with Pool(self.n_jobs) as p:
-            trees = p.map(_mcts_search, all_args)
-        
         all_a = []
         all_vals = []
-        for t in trees:
-            vals = [t[self.history + (a,)]['v'] for a in self.actions]
+        for r in results:
+            vals = np.zeros(self.N)
+            vals[r['root']['actions'] - 1] = r['root']['v_a']
             action = np.argmax(vals) + 1
             all_a.append(action)
             all_vals.append(vals[action-1])
         
-        print('ALL_A', all_a)
-        print('ALL_V', all_vals)
+        self.log(2, 'ALL_A', all_a)
+        self.log(2, 'ALL_V', all_vals)
         # self.trees = trees
         a_ker = _rbf_kernel(all_a, self.bandwidth)
         votes = a_ker @ np.array(all_vals).reshape(-1, 1)
-        print('VOTES', votes)
+        self.log(2, 'VOTES', votes)
         best_idx = np.argmax(votes.flatten())
         a = all_a[best_idx]
 
-        self.tree = self._merge_trees(trees)
+        if is_book_saved:
+            # NOTE: the tree is rerooted on the next step, so the book is written
+            # after the opening decision. Each decision spans a state and an
+            # action key level, so book_depth decisions take 2 * book_depth keys
+            # every worker starts from its own copy of the book, so the book is
+            # added back once and the other copies are taken out, leaving the
+            # book plus each worker's new visits
+            summaries = [r['book_summary'] for r in results]
+            book_summary = book_tree.summarize(2 * self.book_depth)
+            weights = [1] * len(summaries) + [1 - len(summaries)]
+            self.book.save(self._merge_summaries(summaries + [book_summary], weights))
+
+        stats = SearchStats()
+        for r in results:
+            stats.absorb(r['stats'])
+        self.log.record(stats.finish(start_time, n_nodes=sum(r['n_nodes'] for r in results)))
         return a
     
-    def _merge_trees(self, trees):
-        total_tree = trees[0]
-
-        def merge_func(n1, n2):
-            total_n = n1['n'] + n2['n']
-            total_v = 0
-            if total_n != 0:
-                total_v = (n1['n'] * n1['v'] + n2['n'] * n2['v']) / total_n
-            return {'n': total_n, 'v': total_v}
-
-        for t in trees[1:]:
-            total_tree.merge(t, merge_func)
-
-        return total_tree
-    
-    def _round(self, val):
-        return np.round(val, decimals=1)
+    def _merge_summaries(self, summaries, weights=None):
+        ker = _rbf_kernel_by_dist(self.N, self.bandwidth)
+        if weights is None:
+            weights = [1] * len(summaries)
+        keys = set().union(*summaries)
+        merged = {}
+        for key in keys:
+            present = [(summary[key], w) for summary, w in zip(summaries, weights) if key in summary]
+            all_stats, all_w = zip(*present)
+            merged[key] = _merge_node_stats(all_stats, ker, all_w)
+        return MctsTree.from_summary(merged)
 
 def _rbf_kernel(xs, bandwidth):
     xs = np.array(xs).reshape(-1, 1)
     gamma = 1 / bandwidth ** 2
     return rbf_kernel(xs, gamma=gamma)
 
+def _qr_key(qr):
+    '''
+    quantize qr to tenths, packed as bytes for use as a continuum tree key
+    '''
+    return np.round(np.asarray(qr) * 10).astype(np.int16).tobytes()
+
+def _key_qr(key):
+    return np.frombuffer(key, dtype=np.int16) / 10
+
+def _quantize(qr):
+    return np.round(qr * 10) / 10
+
+def _merge_node_stats(all_stats, ker, weights=None):
+    '''
+    pool the statistics of one state node across several searches, summing
+    visits per action and weighting values by them. A negative weight takes
+    a search's statistics back out of the pool
+    '''
+    if weights is None:
+        weights = np.ones(len(all_stats), dtype=int)
+    total_n = sum(w * stats['n'] for w, stats in zip(weights, all_stats))
+    total_v = 0
+    if total_n != 0:
+        total_v = sum(w * stats['n'] * stats['v'] for w, stats in zip(weights, all_stats)) / total_n
+
+    actions, inverse = np.unique(np.concatenate([stats['actions'] for stats in all_stats]), return_inverse=True)
+    n_a = np.concatenate([w * stats['n_a'] for w, stats in zip(weights, all_stats)])
+    total_v_a = np.concatenate([w * stats['n_a'] * stats['v_a'] for w, stats in zip(weights, all_stats)])
+    n_a = np.rint(np.bincount(inverse, weights=n_a, minlength=len(actions))).astype(int)
+    total_v_a = np.bincount(inverse, weights=total_v_a, minlength=len(actions))
+    v_a = np.divide(total_v_a, n_a, out=np.zeros(len(actions)), where=n_a > 0)
+
+    K = ker[np.abs(actions[:,np.newaxis] - actions)]
+    merged = {'v': total_v, 'n': total_n, 'actions': actions, 'n_a': n_a, 'v_a': v_a,
+              'k_n': K @ n_a, 'k_vn': K @ total_v_a}
+
+    if 'n_b' in all_stats[0]:
+        merged['n_b'] = np.sum([w * stats['n_b'] for w, stats in zip(weights, all_stats)], axis=0)
+        merged['r_b'] = np.sum([w * stats['r_b'] for w, stats in zip(weights, all_stats)], axis=0)
+    return merged
+
+@lru_cache(maxsize=8)
+def _action_bins(n_actions, n_bins):
+    '''
+    split actions 1..n_actions into n_bins contiguous bins, each listed in
+    coarse-to-fine order: the bin midpoint first, then the midpoints of each
+    half, and so on. The full goal length leads its bin, as only it can
+    finish the curriculum
+    '''
+    edges = np.linspace(1, n_actions + 1, n_bins + 1).astype(int)
+    bins = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        order = []
+        queue = deque([(lo, hi)])
+        while len(queue) > 0:
+            a, b = queue.popleft()
+            if a < b:
+                mid = (a + b) // 2
+                order.append(mid)
+                queue.extend([(a, mid), (mid + 1, b)])
+
+        if hi == n_actions + 1:
+            order.remove(n_actions)
+            order.insert(0, n_actions)
+
+        order = np.array(order)
+        order.setflags(write=False)
+        bins.append(order)
+    return tuple(bins)
+
+@lru_cache(maxsize=8)
+def _rbf_kernel_by_dist(n_actions, bandwidth):
+    '''
+    rbf kernel between integer actions, indexed by their distance. Shared
+    across searches, so it is read-only
+    '''
+    ker = np.exp(-np.arange(n_actions) ** 2 / bandwidth ** 2)
+    ker.setflags(write=False)
+    return ker
+
 def _mcts_search(params):
     tree = params['tree']
     history = params['history']
@@ -1658,140 +3411,284 @@ def _mcts_search(params):
     gamma = params['gamma']
     eps_end = params['eps_end']
     explore_factor = params['explore_factor']
+    value_cache = params.get('value_cache', None)
+    budget = params.get('budget', SearchBudget())
+    rollout_batch = params.get('rollout_batch', None) or 1
+    n_bins = params.get('action_bins', None)
+    bin_pw_alpha = params.get('bin_pw_alpha', 0.5)
 
-    np.random.seed()   # reset seed from parent
-    K = _rbf_kernel(actions, bandwidth)
+    # NOTE: with action bins, each selection first picks a bin of task
+    # lengths, then an action among the bin's widened candidates. Actions
+    # passed in for flat widening are then unused
+    bins = None if n_bins == None else _action_bins(N_cont, n_bins)
+
+    ker = _rbf_kernel_by_dist(N_cont, bandwidth)
 
     def _init_node():
-        return {'v': 0, 'n': 0}
+        # NOTE: per-action statistics live in arrays on the state node, with
+        # slots added only for actions inside the widening set. Action nodes
+        # exist only once taken, to hold their next-state children. k_n and
+        # k_vn hold the kernel-smoothed visits and returns of each slot, kept
+        # up to date one kernel column at a time
+        stats = {'v': 0, 'n': 0, 'actions': np.zeros(0, dtype=int),
+                 'n_a': np.zeros(0, dtype=int), 'v_a': np.zeros(0),
+                 'k_n': np.zeros(0), 'k_vn': np.zeros(0)}
+        if bins != None:
+            stats['n_b'] = np.zeros(n_bins, dtype=int)
+            stats['r_b'] = np.zeros(n_bins)
+        return stats
+    
+    def _select_bin(stats):
+        n_b = stats['n_b']
+        if np.any(n_b == 0):
+            return np.argmax(n_b == 0)
+
+        vals = stats['r_b'] / n_b + explore_factor * np.sqrt(np.log(np.sum(n_b)) / n_b)
+        return np.argmax(vals)
     
-    def _rollout(history, depth):
-        g = 1
-        total_reward = 0
-
-        while gamma ** depth > eps_end:
-            state = history[-1]
-            a = _sample_inc_policy(state)
-            state, reward, is_done = _sample_transition(state, a)
-
-            history += (a, state)
-            total_reward += g * reward
-            g *= gamma
-            depth += 1
-
-            if is_done:
-                break
+    def _candidates(stats):
+        if bins == None:
+            return None, actions
+
+        b = _select_bin(stats)
+        n_widened = int(np.ceil((stats['n_b'][b] + 1) ** bin_pw_alpha))
+        return b, bins[b][:n_widened]
+    
+    def _action_slots(stats, actions):
+        # add slots for actions newly inside the widening set
+        is_new = ~np.isin(actions, stats['actions'])
+        if np.any(is_new):
+            new_actions = actions[is_new]
+            n_new = len(new_actions)
+            K_new = ker[np.abs(new_actions[:,np.newaxis] - stats['actions'])]
+
+            stats['k_n'] = np.append(stats['k_n'], K_new @ stats['n_a'])
+            stats['k_vn'] = np.append(stats['k_vn'], K_new @ (stats['n_a'] * stats['v_a']))
+            stats['actions'] = np.append(stats['actions'], new_actions)
+            stats['n_a'] = np.append(stats['n_a'], np.zeros(n_new, dtype=int))
+            stats['v_a'] = np.append(stats['v_a'], np.zeros(n_new))
+        
+        if np.array_equal(stats['actions'][:len(actions)], actions):
+            return np.arange(len(actions))
+
+        sorter = np.argsort(stats['actions'])
+        return sorter[np.searchsorted(stats['actions'], actions, sorter=sorter)]
+    
+    def _logsig(qr):
+        return -np.log(1 + np.exp(-(qr + eps_cont)))
+
+    def _rollout_batch(states, depths):
+        qr = np.array(states)
+        depth = np.array(depths)
+
+        total_reward = np.zeros(len(qr))
+        g = np.ones(len(qr))
+        active = gamma ** depth > eps_end
+        is_cut = np.zeros(len(qr), dtype=bool)
+        start_log_probs, start_depth = _logsig(qr), depth.copy()
+
+        while np.any(active):
+            if value_cache != None:
+                idxs = np.flatnonzero(active)
+                is_confident, value = value_cache.lookup(None, _logsig(qr[idxs]), depth[idxs])
+                cut_idxs = idxs[is_confident]
+                total_reward[cut_idxs] += g[cut_idxs] * value[is_confident]
+                active[cut_idxs] = False
+                is_cut[cut_idxs] = True
+
+                if not np.any(active):
+                    break
+
+            idxs = np.flatnonzero(active)
+            a = _sample_inc_policy_batch(qr[idxs])
+            qr[idxs], reward, is_done = _sample_transition_batch(qr[idxs], a)
+
+            total_reward[idxs] += g[idxs] * reward
+            g[idxs] *= gamma
+            depth[idxs] += 1
+            active[idxs] = ~is_done & (gamma ** depth[idxs] > eps_end)
         
+        if value_cache != None:
+            value_cache.update(None, start_log_probs[~is_cut], start_depth[~is_cut], total_reward[~is_cut])
         return total_reward
 
-    def _sample_inc_policy(state):
-        qr = state
-        total_log_prob = 0
-        qs = np.array(qr) + eps_cont
-        for i, q in enumerate(qs):
-            total_log_prob += np.log(sig(q))
-            if total_log_prob < -0.05: # TODO: hardcoded
-                break
-        
-        return i + 1
+    def _sample_inc_policy_batch(qr):
+        below = np.cumsum(_logsig(qr), axis=1) < -0.05   # TODO: hardcoded
+        return np.where(np.any(below, axis=1), np.argmax(below, axis=1), N_cont - 1) + 1
 
-    def _sample_transition(state, action):
-        qr = np.array(state)
-        n = action
+    def _sample_transition_batch(qr, action):
+        # only items inside the longest task can change
+        n_max = np.max(action)
+        head = qr[:,:n_max]
+        in_task = np.arange(n_max) < action.reshape(-1, 1)
 
         for _ in range(T):
-            fail_idx = _sim_fail(n, qr + eps_cont)
-            qr = _update_qr(n, qr, eps_cont, lr, fail_idx)
+            # NOTE: the first failure falls at the number of items whose
+            # cumulative log-success stays above the log of a single uniform
+            cum_log_probs = np.cumsum(np.where(in_task, _logsig(head), 0), axis=1)
+            log_u = np.log(np.random.random((len(head), 1)))
+            fail_idx = np.sum((cum_log_probs >= log_u) & in_task, axis=1)
+            head = _update_qr_batch(action, head, fail_idx)
         
-        reward = 0
-        is_done = False
-        if np.exp(np.sum(np.log(sig(qr + eps_cont)))) > threshold and n == N_cont:
-            is_done = True
-            reward = 10
-        
-        qr = tuple(_round(qr))
-        return qr, reward, is_done
-
-    def _sim_fail(n, qs):
-        for fail_idx, q in enumerate(qs[:n]):
-            if sig(q) < np.random.random():
-                return fail_idx
-        
-        return n
-
-    def _update_qr(n, qr, qe, lr, fail_idx):
-        qr = np.copy(qr).astype('float')
-        if fail_idx == n:
-            payoff = 10  # TODO: hardcoded
-        else:
-            payoff = 0
-        
-        probs = sig(qr[update_width:fail_idx] + qe)
-        exp_return = np.append(probs * qr[update_width:fail_idx], np.repeat(payoff, min(update_width, fail_idx)))
-
-        qr[:fail_idx] += lr * (exp_return - qr[:fail_idx])
-        return qr
-    
-    def _round(val):
-        return np.round(val, decimals=1)
-
-    def _simulate(history):
-        reward_stack = []
-        node_stack = []
-        n_visited_stack = []
+        qr = np.concatenate((head, qr[:,n_max:]), axis=1)
+        is_done = (np.exp(np.sum(_logsig(qr), axis=1)) > threshold) & (action == N_cont)
+        reward = np.where(is_done, 10, 0)
+        return _quantize(qr), reward, is_done
+
+    def _update_qr_batch(n, qr, fail_idx):
+        payoff = np.where(fail_idx == n, 10, 0)  # TODO: hardcoded
+        idxs = np.arange(qr.shape[1])
+
+        # items before fail_idx - update_width move toward the discounted value
+        # of the item update_width ahead, the remaining ones toward the payoff
+        ahead = np.pad(qr, ((0, 0), (0, update_width)))[:,update_width:]
+        exp_return = np.where(idxs < (fail_idx - update_width).reshape(-1, 1),
+                              sig(ahead + eps_cont) * ahead, payoff.reshape(-1, 1))
+        return np.where(idxs < fail_idx.reshape(-1, 1), qr + lr * (exp_return - qr), qr)
+
+    def _descend(history):
+        path = {'nodes': [], 'rewards': [], 'leaf': None}
         depth = 0
+        state = _key_qr(history[-1])
+        cursor = tree.cursor(history)
 
         while gamma ** depth > eps_end:
-            if history not in tree:
-                new_node = MctsNode(_init_node())
-                new_node.children = {a: MctsNode(_init_node()) for a in np.arange(N_cont) + 1}
-                curr_node = tree._traverse(history[:-1])
-                curr_node.children[history[-1]] = new_node
-
-                pred_reward = _rollout(history, depth)
-                reward_stack.append(pred_reward)
+            node = cursor.node
+            if node is None:
+                cursor.expand(_init_node())
+                path['leaf'] = (state, depth)
                 break
             
-            children = tree._traverse(history).children
-            all_next_nodes = [children[a].value for a in actions]
-            results = np.array([(n['v'], n['n']) for n in all_next_nodes])
-            exp_val = K @ (results[:,0] * results[:,1]).reshape(-1, 1)
-            visits = K @ results[:,1].reshape(-1, 1) + 1e-8
+            node_stats = node.value
+            b, candidates = _candidates(node_stats)
+            slots = _action_slots(node_stats, candidates)
+            exp_val = node_stats['k_vn'][slots]
+            visits = node_stats['k_n'][slots] + 1e-8
 
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore')
                 vals = exp_val + explore_factor * np.sqrt(np.log(np.sum(visits)) / visits)
 
-            a = actions[np.argmax(vals)]
-            state = history[-1]
-            next_state, reward, is_done = _sample_transition(state, a)
-            reward_stack.append(reward)
-
-            tree[history]['n'] += 1
-            next_node = tree[history + (a,)]
-            next_node['n'] += 1
-            node_stack.append(next_node)
-            n_visited_stack.append(next_node['n'])
-
-            history += (a, next_state)
-            state = next_state
+            best_idx = np.argmax(vals)
+            a = candidates[best_idx]
+            next_qr, reward, is_done = _sample_transition_batch(state.reshape(1, -1), np.array([a]))
+            path['rewards'].append(reward[0])
+
+            slot = slots[best_idx]
+            ker_col = ker[np.abs(node_stats['actions'] - a)]
+            node_stats['n'] += 1
+            node_stats['n_a'][slot] += 1
+            node_stats['k_n'] += ker_col
+            node_stats['k_vn'] += ker_col * node_stats['v_a'][slot]
+            if b != None:
+                node_stats['n_b'][b] += 1
+            path['nodes'].append((node_stats, slot, a, node_stats['n_a'][slot], b))
+
+            state = next_qr[0]
+            cursor.descend(a, create=True)
+            cursor.descend(_qr_key(state))
             depth += 1
 
-            if is_done:
+            if is_done[0]:
                 break
 
-        # backprop rewards
-        for i, (node, n_visited) in enumerate(zip(node_stack, n_visited_stack)):
-            total_reward = np.sum([r * gamma ** iters for iters, r in enumerate(reward_stack[i:])])
-            node['v'] += (total_reward - node['v']) / n_visited
+        stats.record_depth(len(path['nodes']))
+        return path
+
+    def _backup(path):
+        # accumulate discounted returns from the leaf up
+        rewards = path['rewards']
+        total_reward = 0
+        for i in reversed(range(len(rewards))):
+            total_reward = rewards[i] + gamma * total_reward
+            if i >= len(path['nodes']):
+                continue
+
+            node_stats, slot, a, n_visited, b = path['nodes'][i]
+            old_v = node_stats['v_a'][slot]
+            node_stats['v_a'][slot] += (total_reward - old_v) / n_visited
+            if b != None:
+                node_stats['r_b'][b] += total_reward
+
+            # keep k_vn = K @ (n_a * v_a). Slots may have been added since the
+            # descent, so the kernel column is taken afresh
+            ker_col = ker[np.abs(node_stats['actions'] - a)]
+            node_stats['k_vn'] += ker_col * node_stats['n_a'][slot] * (node_stats['v_a'][slot] - old_v)
 
     '''
     body of overall function
     '''
-    for _ in range(n_particles):
-        _simulate(history)
+    start_time = time.perf_counter()
+    stats = SearchStats()
+    sims = iter(budget.sim_range(n_particles))
+
+    # NOTE: leaves within a batch are rolled out together, so later descents
+    # in the batch do not see the rollout values of earlier ones
+    while True:
+        batch = list(itertools.islice(sims, rollout_batch))
+        if len(batch) == 0:
+            break
+
+        paths = [_descend(history) for _ in batch]
+        leaves = [path for path in paths if path['leaf'] != None]
+        if len(leaves) > 0:
+            rollout_start = time.perf_counter()
+            leaf_states, leaf_depths = zip(*[path['leaf'] for path in leaves])
+            for path, pred_reward in zip(leaves, _rollout_batch(leaf_states, leaf_depths)):
+                path['rewards'].append(pred_reward)
+            stats.rollout_time += time.perf_counter() - rollout_start
+        
+        for path in paths:
+            _backup(path)
+
+        root_stats = tree[history]
+        slots = slice(None) if bins != None else _action_slots(root_stats, actions)
+        if budget.should_stop(root_stats['n_a'][slots], root_stats['v_a'][slots]):
+            break
+
+    return tree, stats.finish(start_time), value_cache
 
-    return tree
+
+def _mcts_worker(conn, params):
+    np.random.seed()   # reset seed from parent
+    tree = MctsTree()
+
+    while True:
+        cmd, arg = conn.recv()
+        if cmd == 'close':
+            break
+
+        elif cmd == 'reset':
+            tree = MctsTree()
+            conn.send(None)
+
+        elif cmd == 'search':
+            is_rerooted = False
+            if arg['key'] == None:
+                if arg['book_tree'] is not None:
+                    tree = arg['book_tree']
+            elif arg['key'] in tree:
+                tree.reroot(arg['key'])
+            else:
+                tree = MctsTree()
+                is_rerooted = True
+
+            search_params = dict(params, tree=tree, history=arg['history'], actions=arg['actions'],
+                                 value_cache=arg['value_cache'], budget=arg['budget'])
+            tree, stats, value_cache = _mcts_search(search_params)
+
+            # only root action arrays go back, the rest of the tree stays here
+            root_stats = tree[arg['history']]
+            result = {
+                'root': {key: root_stats[key] for key in ('actions', 'n_a', 'v_a')},
+                'stats': stats,
+                'value_cache': value_cache,
+                'n_nodes': len(tree),
+                'is_rerooted': is_rerooted
+            }
+            if arg['book_depth'] != None:
+                result['book_summary'] = tree.summarize(2 * arg['book_depth'])
+            conn.send(result)
     
 
 if __name__ == '__main__':
@@ -1817,6 +3714,7 @@ if __name__ == '__main__':
         if is_done:
             break
 
+    teacher.close()
     print('done!')
     plt.plot(traj)
     plt.savefig('traj.png')
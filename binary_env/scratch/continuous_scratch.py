@@ -386,8 +386,8 @@ def run_adaptive_exp(eps=0, goal_length=3, T=3, lr=0.1, max_steps=500, track_qs=
     return traj
 
 
-def run_mcts(eps_eff=0, goal_length=3, T=3, lr=0.1, max_steps=500, gamma=0.95, n_iters=500, n_jobs=4, pw_init=5):
-    teacher = TeacherMctsCont(goal_length, n_jobs=n_jobs, n_iters=n_iters, pw_init=pw_init, gamma=gamma, student_params={'eps_eff': eps_eff})
+def run_mcts(eps_eff=0, goal_length=3, T=3, lr=0.1, max_steps=500, gamma=0.95, n_iters=500, n_jobs=4, pw_init=5, book_path=None):
+    teacher = TeacherMctsCont(goal_length, n_jobs=n_jobs, n_iters=n_iters, pw_init=pw_init, gamma=gamma, student_params={'eps_eff': eps_eff}, book_path=book_path)
 
     env = CurriculumEnv(goal_length=teacher.N, train_round=T, p_eps=0.05, teacher_reward=10, student_reward=10, student_qe_dist=teacher.eps, student_params={'lr': lr, 'n_step':100}, anarchy_mode=True)
     traj = [env.N]
@@ -410,6 +410,7 @@ def run_mcts(eps_eff=0, goal_length=3, T=3, lr=0.1, max_steps=500, gamma=0.95, n
         if is_done:
             break
 
+    teacher.close()
     print('done!')
     return traj
 
@@ -12,15 +12,14 @@ sys.path.append('../')
 from env import *
 
 
-teacher_cache = defaultdict(lambda: None)
-def run_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, max_steps=500):
-    global teacher_cache
-    if teacher_cache[eps] == None:
-        teacher = TeacherPerfectKnowledgeDp(goal_length=goal_length, train_iters=T, n_bins_per_q=bins, student_params={'lr': lr, 'eps': eps})
-        teacher.learn()
-        teacher_cache[eps] = teacher
-    else:
-        teacher = teacher_cache[eps]
+def load_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, cache_dir='dp_cache'):
+    teacher = TeacherPerfectKnowledgeDp(goal_length=goal_length, train_iters=T, n_bins_per_q=bins, student_params={'lr': lr, 'eps': eps}, cache_dir=cache_dir)
+    teacher.learn()
+    return teacher
+
+
+def run_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, max_steps=500, cache_dir='dp_cache'):
+    teacher = load_dp(eps=eps, goal_length=goal_length, bins=bins, T=T, lr=lr, cache_dir=cache_dir)
 
     env = CurriculumEnv(goal_length=goal_length, student_reward=10, student_qe_dist=eps, train_iter=999, train_round=T, student_params={'lr': lr}, anarchy_mode=True)
     traj = [env.N]
@@ -43,8 +42,8 @@ def run_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, max_steps=500):
     return traj
 
 
-def run_mcts(n_iters=500, eps=0, goal_length=3, T=3, gamma=0.9, lr=0.01, max_steps=500):
-    teacher = TeacherPerfectKnowledge(goal_length=goal_length, T=T, gamma=gamma, student_qe=eps, student_lr=lr, n_iters=n_iters)
+def run_mcts(n_iters=500, eps=0, goal_length=3, T=3, gamma=0.9, lr=0.01, max_steps=500, book_path=None):
+    teacher = TeacherPerfectKnowledge(goal_length=goal_length, T=T, gamma=gamma, student_qe=eps, student_lr=lr, n_iters=n_iters, book_path=book_path)
     env = CurriculumEnv(goal_length=goal_length, student_reward=10, student_qe_dist=eps, train_iter=999, train_round=T, student_params={'lr': lr}, anarchy_mode=True)
     traj = [env.N]
     env.reset()
@@ -232,6 +231,17 @@ plt.tight_layout()
 plt.savefig(f'../fig/pk_performance_comparison_bins_{bins}_low_eps.png')
 
 
+# <codecell>  CHECK REACHABLE TRANSITIONS
+# the transitions built by reachable expansion should match the full grid's,
+# restricted to the reachable states
+full = TeacherPerfectKnowledgeDp(goal_length=3, train_iters=3, n_bins_per_q=20)
+reach = TeacherPerfectKnowledgeDp(goal_length=3, train_iters=3, n_bins_per_q=20, reachable_only=True)
+
+for P_full, P_reach in zip(full._get_transitions(), reach._get_transitions()):
+    P_sub = P_full[reach.reachable][:,reach.reachable]
+    assert np.allclose(P_sub.toarray(), P_reach.toarray())
+    assert np.allclose(P_reach.sum(axis=1), 1)
+
 # <codecell>  INSPECT DP POLICY
 # eps = np.arange(-2, 2.1, step=0.5)
 # N = 3
@@ -244,10 +254,10 @@ all_policies = []
 #     all_policies.append(teacher.policy)
 
 for e in tqdm(eps):
-    all_policies.append(teacher_cache[e].policy)
+    all_policies.append(load_dp(e, goal_length=N, bins=bins, lr=lr).policy)
 
 # <codecell>
-slices = teacher_cache[0].state_axis
+slices = load_dp(0, goal_length=N, bins=bins, lr=lr).state_axis
 
 fig, axs = plt.subplots(len(eps), 2 * bins, figsize=(2 * bins * 3, len(eps) * 3))
 mpb = None
@@ -257,7 +267,7 @@ prob_unif = np.ones(N) / N
 ent_max = -np.sum(prob_unif * np.log(prob_unif))
 
 for e, policy, ax_set in zip(eps, all_policies, axs):
-    teacher = teacher_cache[e]
+    teacher = load_dp(e, goal_length=N, bins=bins, lr=lr)
     for ax_p, ax_e, q3 in zip(ax_set[::2], ax_set[1::2], slices):
         img = np.zeros((bins, bins))
         ent = np.zeros((bins, bins))
@@ -289,14 +299,14 @@ plt.savefig(f'../fig/pk_policy_n_{N}_bins_{bins}_with_ent.png', dpi=150)
 
 
 # <codecell>  OVERLAY WITH INCREMENTAL
-slices = teacher_cache[0].state_axis
+slices = load_dp(0, goal_length=N, bins=bins, lr=lr).state_axis
 def sig(x): return 1 / (1 + np.exp(-x))
 
 fig, axs = plt.subplots(len(eps), bins, figsize=(bins * 3, len(eps) * 3))
 mpb = None
 
 for e, policy, ax_set in zip(eps, all_policies, axs):
-    teacher = teacher_cache[e]
+    teacher = load_dp(e, goal_length=N, bins=bins, lr=lr)
 
     xx, yy = np.meshgrid(slices, slices)
     zz = np.zeros(xx.shape)
@@ -336,7 +346,7 @@ plt.savefig(f'../fig/pk_policy_n_{N}_bins_{bins}_with_incremental_overlay.png',
 
 
 # %%
-# teacher = teacher_cache[-1.5]
+# teacher = load_dp(-1.5, goal_length=N, bins=bins, lr=lr)
 # slices = teacher.state_axis
 # mpb = None
 
@@ -361,7 +371,7 @@ eps = 0
 tau = 0.95
 
 # slices = np.linspace(0, 10, 100)
-slices = teacher_cache[0].state_axis
+slices = load_dp(0, goal_length=N, bins=bins, lr=lr).state_axis
 
 xx, yy = np.meshgrid(slices, slices)
 zz = np.zeros(xx.shape)
@@ -268,15 +268,14 @@ def run_adp_double_exp(eps=0, goal_length=3, T=3, max_steps=1000, lr=0.1, **teac
     return traj
 
 
-teacher_cache = defaultdict(lambda: None)
-def run_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, max_steps=500):
-    global teacher_cache
-    if teacher_cache[eps] == None:
-        teacher = TeacherPerfectKnowledgeDp(goal_length=goal_length, train_iters=T, n_bins_per_q=bins, student_params={'lr': lr, 'eps': eps})
-        teacher.learn()
-        teacher_cache[eps] = teacher
-    else:
-        teacher = teacher_cache[eps]
+def load_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, cache_dir='dp_cache'):
+    teacher = TeacherPerfectKnowledgeDp(goal_length=goal_length, train_iters=T, n_bins_per_q=bins, student_params={'lr': lr, 'eps': eps}, cache_dir=cache_dir)
+    teacher.learn()
+    return teacher
+
+
+def run_dp(eps=0, goal_length=3, bins=100, T=3, lr=0.1, max_steps=500, cache_dir='dp_cache'):
+    teacher = load_dp(eps=eps, goal_length=goal_length, bins=bins, T=T, lr=lr, cache_dir=cache_dir)
 
     env = CurriculumEnv(goal_length=goal_length, student_reward=10, student_qe_dist=eps, train_iter=999, train_round=T, student_params={'lr': lr}, anarchy_mode=True)
     traj = [env.N]
@@ -81,97 +81,6 @@ class TeacherUncertainIncremental(Agent):
         self.student_traj = []
 
 
-class TeacherUncertainHasty(Agent):
-    def __init__(self, target_threshold=0.5, confidence=0.95, max_k=10, max_m=150, n_particles=1000, eps_prior=None):
-        self.target_threshold = target_threshold
-        self.confidence = confidence
-        self.max_k = max_k
-        self.max_m = max_m
-        self.n_particles=n_particles
-        self.eps_prior = eps_prior or np.random.randn
-        self.student_traj = []
-
-    def next_action(self, state):
-        _, history = state
-        self.student_traj.extend(history)
-
-        max_thresh = self._get_max_thresh()
-        for k in range(1, self.max_k):
-            conf = self._sim_prob(k, max_thresh)
-            if conf < self.confidence:
-                break
-        
-        return k - 1
-    
-    def _get_max_thresh(self):
-        max_thresh = 1e-8
-        n_success = 0
-        n_fail = 0
-
-        for result in self.student_traj[-self.max_m::][::-1]:
-            n_success += result
-            n_fail += not result
-           
-            thresh = beta.ppf(1 - self.confidence, n_success + 1, n_fail + 1)
-            if thresh > max_thresh:
-                max_thresh = thresh
-        
-        return max_thresh
-
-    def _sim_prob(self, k, s_n):
-        total_success = 0
-        samp_eps = self.eps_prior(size=(self.n_particles, k))
-        prob = np.prod(1 / (1 + np.exp(-samp_eps)), axis=1)
-        total_success = np.sum(prob > self.target_threshold / s_n)
-        return total_success / self.n_particles
-
-    def reset(self):
-        self.student_traj = []
-
-
-class TeacherUncertainAdaptive(TeacherUncertainHasty):
-    def __init__(self, p_eps=0.05, max_m_factor=3, **kwargs):
-        super().__init__(**kwargs)
-        self.p_eps = p_eps
-        self.success_prob = np.exp(-p_eps)
-
-        raw_min_m = np.log(1 - self.confidence) / (-p_eps) - 1
-        self.min_m = int(np.floor(raw_min_m))
-        self.max_m = int(self.min_m * max_m_factor)
-
-    def next_action(self, state):
-        _, trans = state
-        self.student_traj.extend(trans)
-
-        for m in range(self.min_m, 1 + min(self.max_m, len(self.student_traj))):
-            prob_good = self._get_prob_good(self.student_traj[-m:])
-            if prob_good >= self.confidence:
-                jump = self.compute_jump()
-                if jump == 0:
-                    print('warn: jump=0, clipping to 1')
-                    jump = 1
-                return jump
-
-        return 0
-    
-    def _get_prob_good(self, transcript):
-        success = np.sum(transcript)
-        total = len(transcript)
-        prob_bad = beta.cdf(self.success_prob, a=success+1, b=total-success+1)
-        return 1 - prob_bad
-    
-    def compute_jump(self):
-        for k in range(1, self.max_k):
-            conf = self._sim_prob(k, np.exp(-self.p_eps))
-            if conf < self.confidence:
-                break
-        
-        return k - 1
-
-    def reset(self):
-        self.student_traj = []
-
-
 # traj_unc = run_incremental_unc(eps=0)
 # traj_hasty = run_hasty_unc(eps=0, tau=sig(0)*0.95, eps_prior_params=(0, 0.00001))
 